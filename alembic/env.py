@@ -8,7 +8,18 @@ from sqlalchemy import pool
 from alembic import context
 
 
-db_path = os.path.join(os.environ['EMHUB_INSTANCE'], 'emhub.sqlite')
+instance_path = os.environ['EMHUB_INSTANCE']
+db_path = os.path.join(instance_path, 'emhub.sqlite')
+
+
+def get_db_url():
+    """ Use the same database URL of the instance config.py (if any). """
+    config_path = os.path.join(instance_path, 'config.py')
+    db_url = None
+    if os.path.exists(config_path):
+        import runpy
+        db_url = runpy.run_path(config_path).get('SQLALCHEMY_DATABASE_URI')
+    return db_url or 'sqlite:///' + db_path
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -23,9 +34,22 @@ fileConfig(config.config_file_name)
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from emhub.data.data_manager import DataManager
-dm = DataManager(db_path, create=False)
+dm = DataManager(instance_path, dbUrl=get_db_url(), create=False)
 target_metadata = dm.Base.metadata
 
+# Logs are managed by DataLog (with its own metadata), but they can be
+# stored in the main database, so their table should not be dropped
+LOGS_TABLE = 'logs'
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    if type_ == 'table':
+        return name != LOGS_TABLE
+    if type_ in ('index', 'column', 'unique_constraint',
+                 'foreign_key_constraint'):
+        return obj.table.name != LOGS_TABLE
+    return True
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -45,13 +69,14 @@ def run_migrations_offline():
 
     """
     # url = config.get_main_option("sqlalchemy.url")
-    url = 'sqlite:///' + db_path
+    url = get_db_url()
     context.configure(
         url=url,
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
         render_as_batch=True,
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -70,13 +95,14 @@ def run_migrations_online():
     #     prefix="sqlalchemy.",
     #     poolclass=pool.NullPool,
     # )
-    url = 'sqlite:///' + db_path
+    url = get_db_url()
     connectable = sqlalchemy.create_engine(url)
 
     with connectable.connect() as connection:
         context.configure(
             connection=connection, target_metadata=target_metadata,
             render_as_batch = True,
+            include_object=include_object,
         )
 
         with context.begin_transaction():
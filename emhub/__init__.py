@@ -34,6 +34,7 @@ __version__ = '0.1.0'
 
 
 def create_app(test_config=None):
+    import click
     import flask
     import flask_login
 
@@ -292,7 +293,14 @@ def create_app(test_config=None):
 
     from emhub.data.data_manager import DataManager
     app.user = flask_login.current_user
-    app.dm = DataManager(app.instance_path, user=app.user)
+    app.dm = DataManager(app.instance_path, user=app.user,
+                         pragmas=app.config.get('SQLITE_PRAGMAS', None),
+                         engineOptions=app.config.get(
+                             'SQLALCHEMY_ENGINE_OPTIONS', None),
+                         dbUrl=app.config.get('SQLALCHEMY_DATABASE_URI', None),
+                         logsDbUrl=app.config.get(
+                             'SQLALCHEMY_LOGS_DATABASE_URI', None),
+                         bufferedLogs=app.config.get('BUFFERED_LOGS', True))
     app.dc = DataContent(app)
     app.is_devel = (os.environ.get('FLASK_ENV', None) == 'development')
     app.version = __version__
@@ -314,4 +322,27 @@ def create_app(test_config=None):
     def shutdown_session(exception=None):
         app.dm.close()
 
+    @app.cli.command('rebuild-usage')
+    def rebuild_usage():
+        """ Recompute the Applications usage ledger from all bookings. """
+        drift = app.dm.rebuild_usage()
+        for application_id, resource_id, stored, days in drift:
+            print("Application %s, resource %s: stored %s days, counted %s"
+                  % (application_id, resource_id, stored, days))
+        print("Usage ledger rebuilt, %d entries fixed." % len(drift))
+
+    @app.cli.command('archive-logs')
+    @click.option('--days', type=int,
+                  default=lambda: app.config.get('LOGS_RETENTION_DAYS', 90),
+                  help="Logs older than this number of days are archived.")
+    @click.option('--path', default=None,
+                  help="Archive folder (default: instance/logs-archive).")
+    def archive_logs(days, path):
+        """ Move old logs to compressed monthly archive files. """
+        counts = app.dm.archive_logs(days=days, archivePath=path)
+        for month, count in sorted(counts.items()):
+            print("%s: %d logs archived" % (month, count))
+        print("Archived %d logs older than %d days."
+              % (sum(counts.values()), days))
+
     return app
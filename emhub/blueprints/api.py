@@ -28,6 +28,7 @@
 
 import os
 import time
+import json
 
 import flask
 from flask import request
@@ -36,6 +37,8 @@ import flask_login
 
 from emhub.utils import (datetime_from_isoformat, datetime_to_isoformat,
                          send_json_data, send_error)
+from emhub.utils.image import bytes_to_base64
+from emhub.utils.events import sse_message
 from emhub.data import DataContent
 
 
@@ -291,17 +294,27 @@ def get_bookings():
     return filter_request(app.dm.get_bookings)
 
 
-# Shortcut method to get a range of bookings, used by the Calendar
-@api_bp.route('/get_bookings_range', methods=['POST'])
+# Shortcut method to get a range of bookings, used by the Calendar.
+# Only bookings overlapping with the [start, end] window are returned,
+# optionally from some resources (comma separated resource_ids).
+# GET responses contain an ETag, so the client will get 304 (Not Modified)
+# when navigating to a window where nothing has changed.
+@api_bp.route('/get_bookings_range', methods=['GET', 'POST'])
 @flask_login.login_required
 def get_bookings_range():
-    d = request.json or request.form
+    d = request.json if request.is_json else request.values
+    resource_ids = d.get('resource_ids', None)
+    if isinstance(resource_ids, str):
+        resource_ids = [int(rid) for rid in resource_ids.split(',') if rid]
+
     bookings = app.dm.get_bookings_range(
         datetime_from_isoformat(d['start']),
-        datetime_from_isoformat(d['end'])
+        datetime_from_isoformat(d['end']),
+        resource_ids=resource_ids,
+        profile='event'
     )
     func = app.dc.booking_to_event
-    return send_json_data([func(b) for b in bookings])
+    return send_json_data([func(b) for b in bookings], conditional=True)
 
 
 @api_bp.route('/update_booking', methods=['POST'])
@@ -332,6 +345,13 @@ def get_sessions():
 @api_bp.route('/poll_sessions', methods=['POST'])
 @flask_login.login_required
 def poll_sessions():
+    """ Return a pending session. If there is none, wait until sessions
+    are created or updated, up to 'timeout' seconds (60 by default), and
+    return an empty list if there is still no pending session.
+    """
+    timeout = (request.json or {}).get('timeout', 60)
+    deadline = time.time() + timeout
+    lastEventId = app.dm.events.last_id
     session_folders = app.dm.get_session_folders()
 
     def _user(u):
@@ -343,7 +363,7 @@ def poll_sessions():
                     }
 
     while True:
-        sessions = app.dm.get_sessions(condition='status=="pending"')
+        sessions = app.dm.get_sessions(condition={'status': 'pending'})
         if sessions:
             for s in sessions:
                 b = s.booking
@@ -360,7 +380,57 @@ def poll_sessions():
                     'title': e['title']
                  }]
                 return send_json_data(data)
-        time.sleep(3)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return send_json_data([])
+
+        # Sessions might also be created by other server processes,
+        # so check the database again at least every 10 seconds
+        events = app.dm.events.get_events(
+            lastEventId, names=['session_created', 'session_updated'],
+            timeout=min(remaining, 10))
+        if events:
+            lastEventId = events[-1]['id']
+
+
+@api_bp.route('/session_events', methods=['GET'])
+@flask_login.login_required
+def session_events():
+    """ Server-Sent Events stream with the changes in sessions (created,
+    updated, new items) or only in one session if session_id is given.
+    """
+    session_id = request.args.get('session_id', type=int)
+    match = None if session_id is None else {'session_id': session_id}
+    events = app.dm.events
+    headerId = request.headers.get('Last-Event-ID')
+    lastEventId = None if headerId is None else events.parse_id(headerId)
+    # Events after an unknown id (e.g from another server process or
+    # before a restart) might have been missed, so the client is told
+    # to reload the data instead
+    reset = headerId is not None and lastEventId is None
+    if lastEventId is None:
+        lastEventId = events.last_id
+    keepalive = app.config.get('SSE_KEEPALIVE', 15)
+
+    def generate():
+        nonlocal lastEventId
+        if reset:
+            yield sse_message({'name': 'reset', 'data': {}},
+                              events.format_id(lastEventId))
+        while True:
+            newEvents = events.get_events(lastEventId, match=match,
+                                          timeout=keepalive)
+            if newEvents:
+                lastEventId = newEvents[-1]['id']
+                for e in newEvents:
+                    yield sse_message(e, events.format_id(e['id']))
+            else:
+                yield ': keepalive\n\n'
+
+    return flask.Response(generate(), mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache',
+                                   'X-Accel-Buffering': 'no'})
 
 @api_bp.route('/create_session', methods=['POST'])
 @flask_login.login_required
@@ -383,7 +453,12 @@ def delete_session():
 @api_bp.route('/load_session', methods=['POST'])
 @flask_login.login_required
 def load_session():
-    return handle_session(app.dm.load_session)
+    def _load(**attrs):
+        session = app.dm.load_session(**attrs)
+        session.data.close()
+        return session
+
+    return handle_session(_load)
 
 
 @api_bp.route('/create_session_set', methods=['POST'])
@@ -392,7 +467,6 @@ def create_session_set():
     """ Create a set file without actual session. """
     def handle(session, set_id, **attrs):
         session.data.create_set(set_id, attrs)
-        session.data.close()
         return {'session_set': {}}
 
     return handle_session_data(handle, mode="a")
@@ -405,7 +479,9 @@ def add_session_item():
     def handle(session, set_id, **attrs):
         itemId = attrs.pop("item_id")
         session.data.add_set_item(set_id, itemId, attrs)
-        session.data.close()
+        app.dm.events.publish('session_item', {'session_id': session.id,
+                                               'set_id': set_id,
+                                               'item_id': itemId})
         return {'item': {}}
 
     return handle_session_data(handle, mode="a")
@@ -417,21 +493,84 @@ def update_session_item():
     """ Update existing item. """
     def handle(session, set_id, **attrs):
         itemId = attrs.pop("item_id")
-        session.data.update_item(set_id, itemId, attrs)
-        session.data.close()
+        session.data.update_set_item(set_id, itemId, attrs)
         return {'item': {}}
 
     return handle_session_data(handle, mode="a")
 
 
+@api_bp.route('/add_session_items', methods=['POST'])
+@flask_login.login_required
+def add_session_items():
+    """ Add several items in a single request. The 'items' list contains
+    the values of each item, including its 'item_id'.
+    """
+    def handle(session, set_id, items):
+        session.data.add_set_items(set_id, _session_items(items))
+        if items:
+            app.dm.events.publish('session_item',
+                                  {'session_id': session.id,
+                                   'set_id': set_id,
+                                   'item_id': items[-1]['item_id'],
+                                   'count': len(items)})
+        return {'items': {'count': len(items)}}
+
+    return handle_session_data(handle, mode="a")
+
+
+@api_bp.route('/update_session_items', methods=['POST'])
+@flask_login.login_required
+def update_session_items():
+    """ Update several items in a single request (see add_session_items). """
+    def handle(session, set_id, items):
+        session.data.update_set_items(set_id, _session_items(items))
+        return {'items': {'count': len(items)}}
+
+    return handle_session_data(handle, mode="a")
+
+
+def _session_items(items):
+    """ Convert items from the requests ('item_id' key) to the ones
+    expected by SessionData ('id' key).
+    """
+    result = []
+    for item in items:
+        item = dict(item)
+        item['id'] = item.pop('item_id')
+        result.append(item)
+    return result
+
+
+@api_bp.route('/get_session_items', methods=['POST'])
+@flask_login.login_required
+def get_session_items():
+    """ Return the items of a session set, optionally filtered by a
+    condition (e.g 'ctfResolution < 4 and ctfFit > 0.1'), sorted by
+    orderBy (e.g 'ctfResolution') and limited to some items.
+    """
+    def handle(session, set_id, attrList=None, condition=None,
+               orderBy=None, limit=None):
+        items = session.data.get_set_items(set_id, attrList=attrList,
+                                           condition=condition,
+                                           orderBy=orderBy, limit=limit)
+        for item in items:
+            for k, v in item.items():
+                if isinstance(v, bytes):
+                    item[k] = bytes_to_base64(v)
+        return {'items': items}
+
+    return handle_session_data(handle, mode="r")
+
+
 @api_bp.route('/get_session_data', methods=['POST'])
 @flask_login.login_required
 def get_session_data():
-    """ Return some information related to session (e.g CTF values, etc). """
-    def handle(session, set_id, **attrs):
-        result = DataContent(app).get_session_data(session)
-        session.data.close()
-        return result
+    """ Return some information related to session (e.g CTF values, etc).
+    If since_item_id is passed, only values of newer items are returned.
+    """
+    def handle(session, set_id, since_item_id=None, **attrs):
+        return DataContent(app).get_session_data(session,
+                                                 since_item_id=since_item_id)
 
     return handle_session_data(handle, mode="r")
 
@@ -518,21 +657,43 @@ def delete_form():
 # -------------------- UTILS functions ----------------------------------------
 
 def filter_request(func):
-    condition = request.json.get('condition', None)
-    orderBy = request.json.get('orderBy', None)
+    """ Retrieve items using the parameters in the request.
+
+    JSON parameters:
+        condition: structured filter (see emhub.data.data_filter) or the
+            legacy SQL string form.
+        orderBy: column used to sort the items.
+        attrs: only these attributes will be selected from the DB.
+        limit, after_id, after_start: keyset pagination, pass the
+            values from the last item of the previous page.
+        stream: if True, items are sent as they are fetched from the DB,
+            one JSON document per line (application/x-ndjson).
+    """
+    params = request.json
+    attrs = params.get('attrs', None)
+    stream = params.get('stream', False)
+
+    kwargs = {k: params[k] for k in ['limit', 'after_id', 'after_start']
+              if params.get(k, None) is not None}
+
+    items = func(condition=params.get('condition', None),
+                 orderBy=params.get('orderBy', None),
+                 asJson=True, attrs=attrs, iterate=stream, **kwargs)
+
+    if attrs:
+        def _filter(s):
+            return {k: v for k, v in s.items() if k in attrs}
+        items = (_filter(s) for s in items)
 
-    items = func(condition=condition, orderBy=orderBy,
-                 asJson=True)
+    if stream:
+        def _generate():
+            for item in items:
+                yield json.dumps(item) + '\n'
 
-    if 'attrs' in request.json:
-        attrs = request.json['attrs']
+        return flask.Response(flask.stream_with_context(_generate()),
+                              mimetype='application/x-ndjson')
 
-        def _filter(s):
-            return {k: v for k, v in s.items()
-                    if not attrs or k in attrs}
-        items = [_filter(s) for s in items]
-
-    return send_json_data(items)
+    return send_json_data(list(items))
 
 
 def _handle_item(handle_func, result_key):
@@ -606,7 +767,10 @@ def handle_session_data(handle, mode="r"):
     set_id = attrs.pop("set_id", 1)
 
     session = app.dm.load_session(sessionId=session_id, mode=mode)
-    result = handle(session, set_id, **attrs)
+    try:
+        result = handle(session, set_id, **attrs)
+    finally:
+        session.data.close()
 
     return send_json_data(result)
 
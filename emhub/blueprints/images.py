@@ -33,6 +33,7 @@ from flask import request
 from flask import current_app as app
 
 from emhub.utils import send_json_data
+from emhub.utils.image import bytes_to_base64, image_mimetype
 
 
 images_bp = flask.Blueprint('images', __name__)
@@ -62,18 +63,92 @@ def user_profile():
         flask.abort(404)
 
 
+# Kind of images in the URL of session items and the stored attribute
+SESSION_IMAGES = {
+    'micThumb': 'micThumbData',
+    'psd': 'psdData',
+    'ctfFit': 'ctfFitData',
+    'shiftPlot': 'shiftPlotData'
+}
+
+
 @images_bp.route("/get_mic_data", methods=['POST'])
 def get_mic_data():
+    """ Return the CTF values of a micrograph and its images as base64.
+    Images are not included if 'images' is 'false', then they can be
+    retrieved (and cached by the browser) from session_item_image, and
+    'images' contains the hash of each kind of image to be used as
+    version ('v') in their URLs.
+    """
     micId = int(request.form['micId'])
     sessionId = int(request.form['sessionId'])
     session = app.dm.load_session(sessionId)
-    setObj = session.data.get_sets()[0]
-    attrs = [
-        'micThumbData', 'psdData', 'shiftPlotData',
-        'ctfDefocusU', 'ctfDefocusV', 'ctfResolution'
-    ]
+    attrs = ['ctfDefocusU', 'ctfDefocusV', 'ctfResolution']
+    images = request.form.get('images', 'true') == 'true'
+    if images:
+        attrs += ['micThumbData', 'psdData', 'shiftPlotData']
+
+    try:
+        setObj = session.data.get_sets()[0]
+        mic = session.data.get_set_item(setObj['id'], micId, attrList=attrs)
+        if not images:
+            mic['images'] = {
+                kind: session.data.get_set_item_hash(setObj['id'], micId, key)
+                for kind, key in SESSION_IMAGES.items()}
+    finally:
+        session.data.close()
 
-    mic = session.data.get_set_item(setObj['id'], micId, attrList=attrs)
-    session.data.close()
+    # Images are stored as binary data, encode them for the JSON response
+    for k, v in mic.items():
+        if isinstance(v, bytes):
+            mic[k] = bytes_to_base64(v)
 
     return send_json_data(mic)
+
+
+@images_bp.route("/session/<int:session_id>/set/<int:set_id>/item/<int:item_id>/<kind>",
+                 methods=['GET'])
+def session_item_image(session_id, set_id, item_id, kind):
+    """ Send the stored bytes of an image of a session item (PNG, JPEG
+    or WEBP, see the Content-Type). The ETag is built from the hash stored
+    with the image, so conditional requests do not read it. Images can be
+    updated, so they are only cached if the URL has the hash as version
+    ('v' argument, see get_mic_data), otherwise browsers revalidate them.
+    """
+    if (kind not in SESSION_IMAGES
+            or app.dm.get_session_by(id=session_id) is None):
+        flask.abort(404)
+
+    try:
+        session = app.dm.load_session(session_id)
+    except OSError:  # The session has no data file
+        flask.abort(404)
+
+    key = SESSION_IMAGES[kind]
+    data = None
+    try:
+        version = session.data.get_set_item_hash(set_id, item_id, key)
+        etag = '%d-%d-%s-%s' % (set_id, item_id, kind, version)
+        if version is not None and etag not in request.if_none_match:
+            data = session.data.get_set_item(set_id, item_id,
+                                              attrList=[key])[key]
+    except KeyError:
+        version = None
+    finally:
+        session.data.close()
+
+    if version is None:
+        flask.abort(404)
+
+    if data is None:  # Not modified
+        resp = flask.Response(status=304)
+    else:
+        resp = flask.make_response(data)
+        resp.mimetype = image_mimetype(data)
+    resp.set_etag(etag)
+    resp.cache_control.private = True
+    if request.args.get('v') == version:
+        resp.cache_control.max_age = app.config.get('IMAGES_MAX_AGE', 604800)
+    else:
+        resp.cache_control.no_cache = True
+    return resp
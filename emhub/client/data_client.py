@@ -28,7 +28,10 @@
 
 import os
 import json
+import atexit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from contextlib import contextmanager
 
 
@@ -39,44 +42,91 @@ class config:
     EMHUB_PASSWORD = os.environ['EMHUB_PASSWORD']
 
 
+_client = None
+
+
 @contextmanager
 def open_client():
-    dc = DataClient(server_url=config.EMHUB_SERVER_URL)
+    """ Return a client logged in to the server. The same client, with its
+    connections and login cookie, is reused in following calls and it is
+    logged out when the program exits.
+    """
+    global _client
+
+    if _client is None:
+        _client = DataClient(server_url=config.EMHUB_SERVER_URL)
+        atexit.register(_logout_client)
+
+    if _client.cookies is None:
+        _client.login(config.EMHUB_USER, config.EMHUB_PASSWORD)
+
+    yield _client
+
+
+def _logout_client():
     try:
-        dc.login(config.EMHUB_USER, config.EMHUB_PASSWORD)
-        yield dc
-    finally:
-        dc.logout()
+        if _client.cookies is not None:
+            _client.logout()
+    except Exception as e:
+        print("Error logging out: %s" % e)
 
 
 class DataClient:
     """
     Simple client to communicate with the emhub REST API.
+
+    Requests are made through a requests.Session, so connections are kept
+    open and reused. Failed connections and 502 and 503 responses (not
+    processed by the server) are retried with an exponential backoff.
+    If the login expires (401), the client logs in again and repeats the
+    request. Requests fail after the (connect, read) timeout in seconds,
+    the read timeout should be longer than the wait in poll_sessions.
     """
-    def __init__(self, server_url=None):
+    def __init__(self, server_url=None, pool_size=10, retries=5,
+                 backoff_factor=0.5, timeout=(10, 90)):
         self._server_url = server_url or os.environ.get('EMHUB_SERVER_URL',
                                                         'http://127.0.0.1:5000')
         # Store the last request object
         self.cookies = self.r = None
+        self._credentials = None
+        self._timeout = timeout
+
+        # Requests are not retried after a read error or a gateway timeout,
+        # they might have been processed (e.g. adding an item)
+        retry = Retry(total=retries, read=0, backoff_factor=backoff_factor,
+                      status_forcelist=(502, 503), allowed_methods=None,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
     def login(self, username=None, password=None):
         username = username or os.environ['EMHUB_USER']
         password = password or os.environ['EMHUB_PASSWORD']
 
-        self.r = requests.post('%s/api/login' % self._server_url,
-                               json={'username': username,
-                                     'password': password})
+        self.r = self._session.post('%s/api/login' % self._server_url,
+                                    json={'username': username,
+                                          'password': password},
+                                    timeout=self._timeout)
         self.r.raise_for_status()
         self.cookies = self.r.cookies
+        self._credentials = (username, password)
         return self.r
 
     def logout(self):
-        r = requests.post('%s/api/logout' % self._server_url,
-                          cookies=self.cookies)
+        r = self._session.post('%s/api/logout' % self._server_url,
+                               timeout=self._timeout)
         r.raise_for_status()
-        self.cookies = self.r = None
+        self._session.cookies.clear()
+        self.cookies = self.r = self._credentials = None
         return r
 
+    def close(self):
+        """ Close the connections to the server. """
+        self._session.close()
+
     def create_session(self, attrs):
         """ Request the server to create a new session.
         Mandatory in attrs:
@@ -124,6 +174,38 @@ class DataClient:
         """
         return self._method('update_session_item', 'item', attrs)
 
+    def add_session_items(self, attrs):
+        """ Add several items to a set in the session in one request.
+        Mandatory in attrs:
+            session_id: the id of the session
+            set_id: the id of the set
+            items: list of dicts with the item_id and values of each item
+        """
+        return self._method('add_session_items', 'items', attrs)
+
+    def update_session_items(self, attrs):
+        """ Update several items of a set in the session in one request.
+        Mandatory in attrs:
+            session_id: the id of the session
+            set_id: the id of the set
+            items: list of dicts with the item_id and values to update
+        """
+        return self._method('update_session_items', 'items', attrs)
+
+    def get_session_items(self, attrs):
+        """ Get items from a set in the session.
+        Mandatory in attrs:
+            session_id: the id of the session
+            set_id: the id of the set
+        Optional in attrs:
+            attrList: list of attributes to return for each item
+            condition: condition string to filter the items
+                (e.g 'ctfResolution < 4 and ctfFit > 0.1')
+            orderBy: attribute to sort the items (e.g 'ctfFit desc')
+            limit: maximum number of items to return
+        """
+        return self._method('get_session_items', 'items', attrs)
+
     #---------------------- Internal functions ------------------------------
     def _method(self, method, resultKey, attrs):
         r = self.request(method, jsonData={'attrs': attrs})
@@ -139,9 +221,16 @@ class DataClient:
         if self.cookies is None:
             raise Exception("You should call login method first")
 
-        self.r = requests.post('%s/%s/%s'
-                               % (self._server_url, bp, method),
-                               json=jsonData or {},  cookies=self.cookies)
+        url = '%s/%s/%s' % (self._server_url, bp, method)
+        self.r = self._session.post(url, json=jsonData or {},
+                                    timeout=self._timeout)
+
+        if self.r.status_code == 401 and self._credentials:
+            # The login expired (e.g. the server was restarted)
+            self.login(*self._credentials)
+            self.r = self._session.post(url, json=jsonData or {},
+                                        timeout=self._timeout)
+
         self.r.raise_for_status()
         return self.r
 
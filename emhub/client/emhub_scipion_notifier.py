@@ -35,6 +35,8 @@ import datetime as dt
 import argparse
 from pprint import pprint
 from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 
 from pyworkflow.project import Manager
@@ -53,7 +55,7 @@ class config:
 # add emhub source code to the path and import client submodule
 sys.path.append(config.EMHUB_SOURCE)
 
-from emhub.client import DataClient
+from emhub.client import open_client
 from emhub.utils.image import mrc_to_base64
 
 
@@ -63,16 +65,6 @@ def usage(error):
     sys.exit(1)
 
 
-@contextmanager
-def open_client():
-    dc = DataClient(server_url=config.EMHUB_SERVER_URL)
-    try:
-        dc.login(config.EMHUB_USER, config.EMHUB_PASSWORD)
-        yield dc
-    finally:
-        dc.logout()
-
-
 class SetMonitor:
     """ Monitor when there are changes to a given set. """
     def __init__(self, inputSet):
@@ -105,6 +97,59 @@ class SetMonitor:
         return self.count > old_count
 
 
+class ThumbnailRenderer:
+    """ Render the images of items in a pool of processes, ahead of
+    the upload of the items and keeping their order.
+
+    At most maxQueue items are pending to be uploaded, so the rendering
+    does not use too much memory if the upload falls behind.
+    """
+    def __init__(self, workers=None, maxQueue=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.maxQueue = maxQueue or 4 * self.workers
+        self._executor = None
+
+    def __enter__(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._executor.shutdown()
+
+    def render(self, items):
+        """ Iterate over (attrs, images) pairs, where images is a dict
+        with the attribute name as key and the (path, contrast_factor)
+        as value, and yield the attrs with the rendered images.
+        """
+        pending = deque()
+
+        try:
+            for attrs, images in items:
+                futures = {k: self._executor.submit(mrc_to_base64, path,
+                                                    contrast_factor=contrast)
+                           for k, (path, contrast) in images.items()}
+                pending.append((attrs, futures))
+
+                if len(pending) >= self.maxQueue:
+                    yield self._result(*pending.popleft())
+
+            while pending:
+                yield self._result(*pending.popleft())
+        finally:
+            # Do not render the pending items if the caller stops early
+            for _, futures in pending:
+                for f in futures.values():
+                    f.cancel()
+
+    def _result(self, attrs, futures):
+        for k, f in futures.items():
+            try:
+                attrs[k] = f.result()
+            except Exception as e:
+                print("Error rendering %s: %s" % (k, e))
+        return attrs
+
+
 def get_parser():
     """ Return the argparse parser, so we can get the arguments """
 
@@ -129,6 +174,13 @@ def get_parser():
         '--delete', metavar='SESSION_ID', type=int, nargs='+',
         help='Delete one or several sessions.')
 
+    add('--workers', type=int,
+        help="Number of processes to render the images "
+             "(by default the number of cores).")
+    add('--queue', type=int,
+        help="Maximum number of rendered items waiting to be uploaded "
+             "(by default 4 times the number of workers).")
+
     #
     # add('datasets', metavar='DATASET', nargs='*', help='Name of a dataset.')
     # add('--delete', action='store_true',
@@ -147,7 +199,7 @@ def get_parser():
     return parser
 
 
-def notify_session(projName, protId):
+def notify_session(projName, protId, workers=None, maxQueue=None):
     now = dt.datetime.now()
     stamp = now.strftime("%y%m%d%H%M")
 
@@ -219,81 +271,89 @@ def notify_session(projName, protId):
     lastId = 0
     ctfMonitor = SetMonitor(outputCTF)
     micMonitor = SetMonitor(micSet)
+    renderer = ThumbnailRenderer(workers, maxQueue)
 
-    while True:
-        found_new_mics = False
-        ctfSet = SetOfCTF(filename=outputCTF.getFileName())
-        ctfSet.loadAllProperties()
+    with renderer:
+        while True:
+            found_new_mics = False
+            ctfSet = SetOfCTF(filename=outputCTF.getFileName())
+            ctfSet.loadAllProperties()
 
-        with open_client() as dc:
+            with open_client() as dc:
+
+                new_stats = {}
+
+                def _iterItems():
+                    for ctf in ctfSet.iterItems(where="id>%s" % lastId):
+                        u, v, a = ctf.getDefocus()
+                        ctfId = ctf.getObjId()
+                        mic = ctf.getMicrograph()
+
+                        itemAttrs = dict(attrs)
+                        itemAttrs.update({
+                            'item_id': ctfId,
+                            'ctfDefocus': (u + v) * 0.5,
+                            'ctfDefocusU': u,
+                            'ctfDefocusV': v,
+                            'ctfDefocusAngle': a,
+                            'ctfResolution': ctf.getResolution(),
+                            'ctfFit': ctf.getFitQuality(),
+                            'location': mic.getFileName(),
+                            'ctfFitData': '',
+                            'shiftPlotData': ''
+                        })
+
+                        images = {}
+                        psdPath = os.path.join(project.path, ctf.getPsdFile())
+                        if os.path.exists(psdPath):
+                            images['psdData'] = (psdPath, 5)
+
+                        micPath = os.path.join(project.path, mic.getFileName())
+                        if os.path.exists(micPath):
+                            images['micThumbData'] = (micPath, 10)
+
+                        yield itemAttrs, images
+
+                # Images are rendered in parallel while items are uploaded.
+                # lastId is only updated after each item is uploaded, so if
+                # an upload fails (after the retries of the client), the
+                # remaining items are sent again in the next iteration.
+                uploadFailed = False
+                for itemAttrs in renderer.render(_iterItems()):
+                    print("Adding item %06d" % itemAttrs['item_id'])
 
-            new_stats = {}
-
-            for ctf in ctfSet.iterItems(where="id>%s" % lastId):
-                u, v, a = ctf.getDefocus()
-                lastId = ctfId = ctf.getObjId()
-                mic = ctf.getMicrograph()
-
-                attrs.update({
-                    'item_id': ctfId,
-                    'ctfDefocus': (u + v) * 0.5,
-                    'ctfDefocusU': u,
-                    'ctfDefocusV': v,
-                    'ctfDefocusAngle': a,
-                    'ctfResolution': ctf.getResolution(),
-                    'ctfFit': ctf.getFitQuality(),
-                    'location': mic.getFileName(),
-                    'ctfFitData': '',
-                    'shiftPlotData': ''
-                })
-
-                print("Adding item %06d" % ctfId)
-                psdPath = os.path.join(project.path, ctf.getPsdFile())
-
-                if os.path.exists(psdPath):
-                    print("  PSD: ", psdPath)
-                    attrs['psdData'] = mrc_to_base64(psdPath,
-                                                     contrast_factor=5)
-
-                micPath = os.path.join(project.path, ctf.getMicrograph().getFileName())
-                if os.path.exists(micPath):
-                    print("  MIC: ", micPath)
-                    attrs['micThumbData'] = mrc_to_base64(micPath,
-                                                          contrast_factor=10)
-
-                for i in range(3):  # try 3 times
                     try:
-                        dc.add_session_item(attrs)
-                        break
+                        dc.add_session_item(itemAttrs)
                     except Exception as e:
                         print("dc.add_session_item:: Error: %s" % e)
-                        print("                      Trying again in 3 seconds.")
-                        time.sleep(3)
+                        uploadFailed = True
+                        break
 
-                new_stats['numOfCtfs'] = ctfSet.getSize()
+                    lastId = itemAttrs['item_id']
+                    new_stats['numOfCtfs'] = ctfSet.getSize()
 
-            # Check if there are new micrographs
-            if micMonitor.update_count():
-                new_stats['numOfMics'] = micMonitor.count
+                # Check if there are new micrographs
+                if micMonitor.update_count():
+                    new_stats['numOfMics'] = micMonitor.count
 
-            if new_stats:
-                stats.update(new_stats)
-                print("Updating session stats: ")
-                print("   Mics: ", micMonitor.count)
-                print("   CTFs: ", ctfSet.getSize())
+                if new_stats:
+                    stats.update(new_stats)
+                    print("Updating session stats: ")
+                    print("   Mics: ", micMonitor.count)
+                    print("   CTFs: ", ctfSet.getSize())
 
-                dc.update_session({'id': sessionId, 'stats': stats})
-            else:
-                time.sleep(10)
+                    dc.update_session({'id': sessionId, 'stats': stats})
+                else:
+                    time.sleep(10)
 
-        ctfSet.close()
+            ctfSet.close()
 
-        print("lastId: ", lastId)
+            print("lastId: ", lastId)
 
-        if ctfSet.isStreamClosed():
-            with open_client() as dc:
-                dc.update_session({'id': sessionId, 'status': 'finished'})
-            break
+            if ctfSet.isStreamClosed() and not uploadFailed:
+                with open_client() as dc:
+                    dc.update_session({'id': sessionId, 'status': 'finished'})
+                break
 
 
 def main():
@@ -315,7 +375,8 @@ def main():
     elif args.create:
         projName = args.create[0]
         protId = int(args.create[1])
-        notify_session(projName, protId)
+        notify_session(projName, protId,
+                       workers=args.workers, maxQueue=args.queue)
 
 
 if __name__ == '__main__':
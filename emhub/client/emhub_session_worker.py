@@ -157,7 +157,9 @@ def main():
         try:
             with open_client() as dc:
                 eprint("Connected to server: ", config.EMHUB_SERVER_URL)
-                r = dc.request('poll_sessions', jsonData={})
+                # The server waits until there are pending sessions
+                # or returns an empty list after the timeout
+                r = dc.request('poll_sessions', jsonData={'timeout': 60})
 
                 for s in r.json():
                     eprint("Handling session %s: " % s['id'])
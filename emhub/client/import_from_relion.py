@@ -71,10 +71,12 @@ STAR_DICT = {
 
 
 class ImportRelionSession:
-    def __init__(self, path):
+    def __init__(self, path, batch_size=20):
         self.path = path
         self.session_name = os.path.basename(self.path)
         self.results = dict()
+        # Number of items added in each request (items contain images)
+        self.batch_size = batch_size
 
     def parseRelionJobs(self):
         """ Parse Relion jobs into a dict. """
@@ -165,12 +167,21 @@ class ImportRelionSession:
         sc.create_session_set(session_set)
         print("Created new set with id: 1")
 
-        # Add new items one by one
+        # Add new items in batches, one request for each batch
+        def _addItems(items):
+            print("=" * 80, "\nAdding items: %s - %s"
+                  % (items[0]['item_id'], items[-1]['item_id']))
+            sc.add_session_items(dict(session_set, items=items))
+
+        items = []
         for item in self.iterateItemsAttrs():
-            item.update(session_set)
-            print("=" * 80, "\nAdding item: %s" % item['item_id'])
+            items.append(item)
+            if len(items) == self.batch_size:
+                _addItems(items)
+                items = []
 
-            sc.add_session_item(item)
+        if items:
+            _addItems(items)
 
     def run(self):
         """ Main execute function. """
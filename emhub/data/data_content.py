@@ -115,15 +115,25 @@ class DataContent:
                                             orderBy='resource_id')
         return {'sessions': sessions}
 
-    def get_session_data(self, session):
-        firstSetId = session.data.get_sets()[0]['id']
-        attrList = ['location', 'ctfDefocus', 'ctfResolution']
-        mics = session.data.get_set_items(firstSetId, attrList=attrList)
-        session.data.close()
+    def get_session_data(self, session, since_item_id=None):
+        """ Return the CTF plots, histograms and counters of the session.
 
-        def _get_hist(label, inputList):
-            import numpy as np
-            hist, bins = np.histogram(inputList)
+        If since_item_id is given, the plots only contain the values of
+        the items added after that one, to be appended by the client.
+        """
+        firstSetId = session.data.get_sets()[0]['id']
+        attrList = ['id', 'ctfDefocus', 'ctfResolution']
+        condition = None
+        if since_item_id is not None:
+            condition = 'id > %d' % int(since_item_id)
+        mics = session.data.get_set_items(firstSetId, attrList=attrList,
+                                          condition=condition)
+        # Histograms are computed from the stats stored with the set
+        setStats = session.data.get_set_stats(firstSetId,
+                                              ['ctfDefocus', 'ctfResolution'])
+
+        def _get_hist(label, key):
+            hist, bins = setStats[key].histogram()
             return {
                 'label': label,
                 'data': [int(h) for h in hist],
@@ -133,24 +143,32 @@ class DataContent:
         defocusList = [m['ctfDefocus'] for m in mics]
         resolutionList = [m['ctfResolution'] for m in mics]
         stats = session.stats
+        numOfCtfs = setStats['ctfDefocus'].count
+        numOfMics = max(stats.get('numOfMics', 0), numOfCtfs)
 
         return {
             'defocus_plot': ['Defocus'] + defocusList,
-            'ctf_defocus_hist': _get_hist('CTF Defocus', defocusList),
+            'ctf_defocus_hist': _get_hist('CTF Defocus', 'ctfDefocus'),
             'resolution_plot': ['Resolution'] + resolutionList,
-            'ctf_resolution_hist': _get_hist('CTF Resolution', resolutionList),
+            'ctf_resolution_hist': _get_hist('CTF Resolution',
+                                             'ctfResolution'),
             'session': session.json(),
+            'last_item_id': (max(m['id'] for m in mics) if mics
+                             else since_item_id or 0),
             'counters': {
-                'imported': stats['numOfMics'],
-                'aligned': stats['numOfMics'],
-                'ctf': stats['numOfCtfs'],
+                'imported': numOfMics,
+                'aligned': numOfMics,
+                'ctf': numOfCtfs,
                 'picked': 0
             }}
 
     def get_session_live(self, **kwargs):
         session_id = kwargs['session_id']
         session = self.app.dm.load_session(session_id)
-        return self.get_session_data(session)
+        try:
+            return self.get_session_data(session)
+        finally:
+            session.data.close()
 
     def get_session_details(self, **kwargs):
         session_id = kwargs['session_id']
@@ -272,9 +290,8 @@ class DataContent:
     def get_booking_calendar(self, **kwargs):
         dm = self.app.dm  # shortcut
         dataDict = self.get_resources_list()
-        dataDict['bookings'] = [self.booking_to_event(b)
-                                for b in dm.get_bookings()
-                                if b.resource is not None]
+        # Bookings are not included here, the calendar will request
+        # the ones in the visible range (see api.get_bookings_range)
         dataDict['current_user_json'] = flask_login.current_user.json()
         dataDict['applications'] = [{'id': a.id,
                                      'code': a.code,
@@ -358,12 +375,28 @@ class DataContent:
 
     def get_logs(self, **kwargs):
         dm = self.app.dm
-        logs = int(kwargs.get('n', 100))
-        logs = dm.get_logs()[-logs:  ]
+        params = {'limit': int(kwargs.get('n', 100))}
+
+        for key in ['start', 'end']:
+            if key in kwargs:
+                params[key] = datetime_from_isoformat(kwargs[key])
+        if 'user_id' in kwargs:
+            params['user_id'] = int(kwargs['user_id'])
+        for key in ['type', 'name']:
+            if key in kwargs:
+                params['log_' + key] = kwargs[key]
+
+        logs = dm.get_logs(**params)
+
+        # Retrieve all users of the logs with a single query
+        user_ids = list({log.user_id for log in logs
+                         if log.user_id is not None})
+        users = {u.id: u for u in dm.get_users(
+            condition={'field': 'id', 'op': 'in', 'value': user_ids})}
         for log in logs:
-            log.user = dm.get_user_by(id=log.user_id)
+            log.user = users.get(log.user_id, None)
 
-        return  {'logs': logs}
+        return {'logs': logs}
 
     def get_pages(self, **kwargs):
         page_id = kwargs['page_id']
@@ -677,7 +710,7 @@ class DataContent:
 
         entries = []
 
-        for b in dm.get_bookings():
+        for b in dm.get_bookings(profile='event'):
             if _filter(b):
                 entries.append({'id': b.id,
                                 'title': self.booking_to_event(b)['title'],
@@ -858,7 +891,7 @@ class DataContent:
 
     # --------------------- RAW (development) content --------------------------
     def get_raw_booking_list(self, **kwargs):
-        bookings = self.app.dm.get_bookings()
+        bookings = self.app.dm.get_bookings(profile='event')
         return {'bookings': [self.booking_to_event(b) for b in bookings]}
 
     def get_raw_applications_list(self, **kwargs):
@@ -1024,7 +1057,7 @@ class DataContent:
     def get_create_session_form(self, **kwargs):
         dm = self.app.dm  # shortcut
         booking_id = kwargs['booking_id']
-        b = dm.get_bookings(condition="id=%s" % booking_id)[0]
+        b = dm.get_bookings(condition={'id': booking_id})[0]
 
         return {
             'booking': b,
@@ -1164,7 +1197,7 @@ class DataContent:
         return staff
 
     def _get_display_condition(self):
-        """ Compose condition str for the get_sessions query.
+        """ Compose condition for the get_sessions query.
         Depending on the user role we show specific sessions only.
         """
         user = self.app.user
@@ -1172,11 +1205,11 @@ class DataContent:
         if user.is_manager:
             return None
 
-        condition = 'operator_id == %s' % user.get_id()
+        condition = {'operator_id': user.id}
         lab_members = user.get_lab_members()
         if user.is_pi and len(lab_members):
-            membersId = ",".join(u.get_id() for u in lab_members)
-            condition = "operator_id IN (%s)" % membersId
+            condition = {'field': 'operator_id', 'op': 'in',
+                         'value': [u.id for u in lab_members]}
 
         return condition
 
@@ -1290,7 +1323,8 @@ class DataContent:
 
         bookings = self.app.dm.get_bookings_range(
             datetime_from_isoformat(d['start'].replace('/', '-')),
-            datetime_from_isoformat(d['end'].replace('/', '-'))
+            datetime_from_isoformat(d['end'].replace('/', '-')),
+            profile='event'
         )
 
         def process_booking(b):
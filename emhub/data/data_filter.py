@@ -0,0 +1,192 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+"""
+Structured filters that can be used instead of raw SQL conditions.
+
+A filter is a JSON-like tree that is compiled into a SQLAlchemy expression
+with bound parameters. The following forms are accepted:
+
+    {"field": "type", "op": "==", "value": "booking"}
+    {"and": [filter1, filter2, ...]}
+    {"or": [filter1, filter2, ...]}
+    {"not": filter}
+    [filter1, filter2, ...]           (same as "and")
+    {"type": "booking", "id": 10}     (shortcut for "==" on each field)
+
+Compiled expressions only depend on the "shape" of the filter (fields and
+operators, not values), so they are cached and the same SQL statement is
+reused for filters that only differ in their values.
+"""
+
+import operator
+from functools import lru_cache
+
+from sqlalchemy import and_, or_, not_, bindparam, DateTime
+
+from emhub.utils import datetime_from_isoformat
+
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'like': lambda c, p: c.like(p),
+    'in': lambda c, p: c.in_(p),
+    'not_in': lambda c, p: c.not_in(p),
+}
+
+# Operators that do not take any value
+NULL_OPERATORS = {
+    'is_null': lambda c: c.is_(None),
+    'not_null': lambda c: c.is_not(None),
+}
+
+LOGIC_OPERATORS = {'and': and_, 'or': or_}
+
+
+def _iter_nodes(node):
+    """ Normalize the filter node and return (kind, content). """
+    if isinstance(node, list):
+        return 'and', node
+
+    if not isinstance(node, dict) or not node:
+        raise Exception("Invalid filter: %s" % node)
+
+    for key in ['and', 'or', 'not']:
+        if key in node:
+            if len(node) > 1:
+                raise Exception("Invalid filter, '%s' should be the only "
+                                "key: %s" % (key, node))
+            return key, node[key]
+
+    if 'field' in node:
+        return 'op', node
+
+    # Shortcut form: {field1: value1, field2: value2}
+    return 'and', [{'field': k, 'op': '==', 'value': v}
+                   for k, v in node.items()]
+
+
+def filter_shape(node):
+    """ Return a hashable representation of the filter without values. """
+    kind, content = _iter_nodes(node)
+
+    if kind == 'op':
+        field, op = content['field'], content.get('op', '==')
+        # Check them here, they should be hashable to cache the shape
+        if not isinstance(field, str):
+            raise Exception("Invalid filter, unknown field '%s'" % field)
+        if not isinstance(op, str) or (op not in OPERATORS
+                                        and op not in NULL_OPERATORS):
+            raise Exception("Invalid filter, unknown operator '%s'" % op)
+        return kind, field, op
+    elif kind == 'not':
+        return kind, filter_shape(content)
+    else:
+        return (kind,) + tuple(filter_shape(n) for n in content)
+
+
+def filter_values(node, values=None):
+    """ Return the list of values of the filter, in the same order of the
+    parameters in the compiled expression.
+    """
+    values = [] if values is None else values
+    kind, content = _iter_nodes(node)
+
+    if kind == 'op':
+        if content.get('op', '==') not in NULL_OPERATORS:
+            values.append(content['value'])
+    elif kind == 'not':
+        filter_values(content, values)
+    else:
+        for n in content:
+            filter_values(n, values)
+
+    return values
+
+
+@lru_cache(maxsize=256)
+def _compile_shape(ModelClass, shape):
+    """ Create the expression for a given filter shape.
+    Return the expression and the list of (param_name, column) that
+    should be provided when executing the query.
+    """
+    params = []
+
+    def _compile(s):
+        kind = s[0]
+        if kind == 'op':
+            _, field, op = s
+            column = ModelClass.__table__.columns.get(field, None)
+            if column is None:
+                raise Exception("Invalid filter, unknown field '%s' for %s"
+                                % (field, ModelClass.__name__))
+            if op in NULL_OPERATORS:
+                return NULL_OPERATORS[op](getattr(ModelClass, field))
+            if op not in OPERATORS:
+                raise Exception("Invalid filter, unknown operator '%s'" % op)
+            name = 'p%d' % len(params)
+            params.append((name, column))
+            p = bindparam(name, expanding=op in ('in', 'not_in'))
+            return OPERATORS[op](getattr(ModelClass, field), p)
+        elif kind == 'not':
+            return not_(_compile(s[1]))
+        else:
+            return LOGIC_OPERATORS[kind](*[_compile(n) for n in s[1:]])
+
+    return _compile(shape), params
+
+
+def _convert_value(column, value):
+    """ Convert string values for DateTime columns. """
+    if isinstance(value, list):
+        return [_convert_value(column, v) for v in value]
+
+    # Custom types (e.g. UtcDateTime) wrap the base type in impl
+    column_type = getattr(column.type, 'impl', column.type)
+    if isinstance(column_type, DateTime) and isinstance(value, str):
+        return datetime_from_isoformat(value)
+
+    return value
+
+
+def compile_filter(ModelClass, node):
+    """ Compile the filter for the given model.
+
+    Returns:
+        expression, params: the SQLAlchemy expression and the dict with
+            values for its bound parameters.
+    """
+    expr, params = _compile_shape(ModelClass, filter_shape(node))
+    values = filter_values(node)
+    return expr, {name: _convert_value(column, v)
+                  for (name, column), v in zip(params, values)}
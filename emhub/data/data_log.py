@@ -26,7 +26,18 @@
 # *
 # **************************************************************************
 
-from sqlalchemy import Column, Integer, String, JSON
+import os
+import atexit
+import gzip
+import json
+import queue
+import datetime as dt
+from collections import defaultdict
+import threading
+import traceback
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, JSON, Index
 from sqlalchemy_utc import UtcDateTime
 
 from .data_db import DbManager
@@ -34,9 +45,38 @@ from .data_db import DbManager
 
 class DataLog(DbManager):
     """ Main class that will manage the logs about data operations.
+
+    By default, each log is written (and committed) when calling the
+    log method. If buffered is True, logs are put in a bounded queue and
+    written in batches by a background thread, so the caller does not
+    wait for the commit.
     """
-    def __init__(self, dbPath, cleanDb=False):
-        self.init_db(dbPath, cleanDb=cleanDb)
+    def __init__(self, dbPath, cleanDb=False, buffered=False,
+                 maxQueue=10000, batchSize=500, **kwargs):
+        """
+        Args:
+            buffered: use a background thread to write the logs.
+            maxQueue: maximum number of pending logs, when the queue is
+                full, the log call will block until there is space.
+            batchSize: maximum number of logs written in one transaction.
+        """
+        self.init_db(dbPath, cleanDb=cleanDb, **kwargs)
+
+        # Existing databases might not have the indexes
+        engine = self._db_session.get_bind()
+        for index in self.Log.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+        self._buffered = buffered
+        self._batchSize = batchSize
+        self._queue = self._thread = None
+
+        if buffered:
+            self._queue = queue.Queue(maxsize=maxQueue)
+            self._thread = threading.Thread(target=self.__write_logs,
+                                            name='DataLog', daemon=True)
+            self._thread.start()
+            atexit.register(self.shutdown)
 
     def _create_models(self):
         """ Function called from the init_db method. """
@@ -44,6 +84,11 @@ class DataLog(DbManager):
         class Log(self.Base):
             """Model for user accounts."""
             __tablename__ = 'logs'
+            __table_args__ = (
+                Index('ix_logs_timestamp', 'timestamp'),
+                Index('ix_logs_user_timestamp', 'user_id', 'timestamp'),
+                Index('ix_logs_type_name', 'type', 'name'),
+            )
 
             id = Column(Integer,
                         primary_key=True)
@@ -71,20 +116,161 @@ class DataLog(DbManager):
 
     def log(self, log_user_id, log_type, log_name,
             *args, **kwargs):
+        """ Store a new log entry. In buffered mode, the entry is queued
+        and None is returned instead of the new Log object.
+        """
+        values = dict(user_id=log_user_id,
+                      type=log_type,
+                      name=log_name,
+                      timestamp=self.now(),
+                      args=args,
+                      kwargs=kwargs)
 
-        log = self.Log(
-            user_id=log_user_id,
-            type=log_type,
-            name=log_name,
-            timestamp=self.now(),
-            args=args,
-            kwargs=kwargs)
+        if self._buffered and self._thread.is_alive():
+            self._queue.put(values)
+            return None
 
+        log = self.Log(**values)
         self._db_session.add(log)
         self.commit()
 
         return log
 
-    def get_logs(self):
-        return self._db_session.query(self.Log).all()
+    def flush(self):
+        """ Wait until all queued logs are written. """
+        if self._buffered and self._thread.is_alive():
+            self._queue.join()
+
+    def shutdown(self):
+        """ Write pending logs and stop the background thread. """
+        if self._buffered and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def get_logs(self, start=None, end=None, user_id=None,
+                 log_type=None, log_name=None, limit=None,
+                 before_timestamp=None, before_id=None):
+        """ Return logs sorted from the most recent to the oldest.
+
+        Keyword Args:
+            start, end: only logs with timestamp in this range.
+            user_id, log_type, log_name: filter by these values.
+            limit: maximum number of logs to return.
+            before_timestamp, before_id: return logs older than the given
+                one, used to retrieve the next page of logs.
+        """
+        self.flush()
+        Log = self.Log
+        query = self._db_session.query(Log)
+
+        if start is not None:
+            query = query.filter(Log.timestamp >= start)
+        if end is not None:
+            query = query.filter(Log.timestamp <= end)
+        if user_id is not None:
+            query = query.filter(Log.user_id == user_id)
+        if log_type is not None:
+            query = query.filter(Log.type == log_type)
+        if log_name is not None:
+            query = query.filter(Log.name == log_name)
+
+        if before_timestamp is not None:
+            cond = Log.timestamp < before_timestamp
+            if before_id is not None:
+                cond = sqlalchemy.or_(
+                    cond, sqlalchemy.and_(Log.timestamp == before_timestamp,
+                                          Log.id < before_id))
+            query = query.filter(cond)
+
+        query = query.order_by(Log.timestamp.desc(), Log.id.desc())
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        return query.all()
+
+    def archive_logs(self, archivePath, days=90, batchSize=1000,
+                     vacuum=True):
+        """ Move logs older than the given number of days to monthly
+        archive files (gzip compressed JSON-lines), named as
+        logs-YYYY-MM.jsonl.gz inside archivePath.
+
+        Returns:
+            dict with the number of archived logs per month.
+        """
+        self.flush()
+        Log = self.Log
+        cutoff = self.now() - dt.timedelta(days=days)
+        os.makedirs(archivePath, exist_ok=True)
+        counts = defaultdict(int)
+        query = self._db_session.query(Log).filter(
+            Log.timestamp < cutoff).order_by(Log.id).limit(batchSize)
+
+        while True:
+            logs = query.all()
+            if not logs:
+                break
+
+            months = defaultdict(list)
+            for log in logs:
+                months[log.timestamp.strftime('%Y-%m')].append(log)
+
+            for month, monthLogs in months.items():
+                fn = os.path.join(archivePath, 'logs-%s.jsonl.gz' % month)
+                # Appending creates a new gzip member, still readable
+                with gzip.open(fn, 'at') as f:
+                    for log in monthLogs:
+                        f.write(json.dumps(self.json_from_object(log)) + '\n')
+                counts[month] += len(monthLogs)
+
+            # Only remove logs after they have been written
+            ids = [log.id for log in logs]
+            self._db_session.query(Log).filter(Log.id.in_(ids)).delete(
+                synchronize_session=False)
+            self.commit()
+
+        engine = self._db_session.get_bind()
+        if counts and vacuum and engine.dialect.name == 'sqlite':
+            self.close()
+            with engine.connect() as conn:
+                conn.exec_driver_sql('VACUUM')
+
+        return dict(counts)
+
+    @staticmethod
+    def read_archive(filename):
+        """ Iterate over the logs (as dicts) in an archive file. """
+        with gzip.open(filename, 'rt') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def __write_logs(self):
+        """ Function running in the background thread. """
+        running = True
+
+        while running:
+            batch = [self._queue.get()]
+            try:
+                # Take all logs queued while writing the previous batch
+                while len(batch) < self._batchSize:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if None in batch:  # Shutdown requested
+                running = False
+                batch.remove(None)
 
+            try:
+                if batch:
+                    self._db_session.bulk_insert_mappings(self.Log, batch)
+                    self.commit()
+            except Exception as e:
+                print("ERROR writing %d logs: %s" % (len(batch), e))
+                traceback.print_exc()
+                self._db_session.rollback()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+                if not running:
+                    self._queue.task_done()  # Shutdown sentinel
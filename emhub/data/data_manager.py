@@ -29,36 +29,74 @@
 import datetime as dt
 import os
 import uuid
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 
 import sqlalchemy
+from sqlalchemy.orm import joinedload
 
 from emhub.utils import datetime_from_isoformat, datetime_to_isoformat
+from emhub.utils.events import EventBus
 from .data_db import DbManager
+from .data_filter import compile_filter
 from .data_log import DataLog
 from .data_models import create_data_models
-from .data_session import H5SessionData
+from .data_session import H5SessionData, SessionDataCache
 
 
 class DataManager(DbManager):
     """ Main class that will manage the sessions and their information.
     """
+    # Relations that will be eagerly loaded when retrieving bookings
+    # with a given profile. The 'event' profile contains all relations
+    # used by DataContent.booking_to_event
+    BOOKING_PROFILES = {
+        'event': ['resource', 'owner.pi', 'operator', 'creator',
+                  'application.creator']
+    }
+
     def __init__(self, dataPath, dbName='emhub.sqlite',
-                 user=None, cleanDb=False, create=True):
+                 user=None, cleanDb=False, create=True,
+                 pragmas=None, engineOptions=None,
+                 dbUrl=None, logsDbUrl=None, bufferedLogs=False):
+        """
+        Args:
+            pragmas, engineOptions: database engine settings, used for
+                both main and logs databases (see DbManager.init_db).
+            dbUrl: URL of the main database, if None, the SQLite
+                file dbName inside dataPath is used.
+            logsDbUrl: URL of the logs database, if None, dbUrl is used
+                or a SQLite file next to the main one.
+            bufferedLogs: write logs in a background thread
+                (see DataLog).
+        """
         self._dataPath = dataPath
         self._sessionsPath = os.path.join(dataPath, 'sessions')
 
         # Initialize main database
-        dbPath = os.path.join(dataPath, dbName)
-        self.init_db(dbPath, cleanDb=cleanDb, create=create)
+        dbPath = dbUrl or os.path.join(dataPath, dbName)
+        self.init_db(dbPath, cleanDb=cleanDb, create=create,
+                     pragmas=pragmas, engineOptions=engineOptions)
 
-        self._lastSession = None
+        # Share open session files between requests, while they are not
+        # modified (see SessionDataCache)
+        self._sessionsCache = SessionDataCache()
         self._user = user  # Logged user
+        # Notify waiting clients about sessions changes
+        self.events = EventBus()
 
         if create:
             # Create a separate database for logs
-            logDbPath = dbPath.replace('.sqlite', '-logs.sqlite')
-            self._db_log = DataLog(logDbPath, cleanDb=cleanDb)
+            if logsDbUrl:
+                logDbPath = logsDbUrl
+            elif dbUrl:
+                logDbPath = dbUrl
+            else:
+                logDbPath = dbPath.replace('.sqlite', '-logs.sqlite')
+            self._db_log = DataLog(logDbPath, cleanDb=cleanDb,
+                                   buffered=bufferedLogs,
+                                   pragmas=pragmas,
+                                   engineOptions=engineOptions)
 
             # Create sessions dir if not exists
             os.makedirs(self._sessionsPath, exist_ok=True)
@@ -73,8 +111,18 @@ class DataManager(DbManager):
         self._db_log.log(log_user_id, log_type, log_name,
                          *args, **kwargs)
 
-    def get_logs(self):
-        return self._db_log.get_logs()
+    def get_logs(self, **kwargs):
+        """ Return logs, see DataLog.get_logs for the arguments. """
+        return self._db_log.get_logs(**kwargs)
+
+    def archive_logs(self, days=90, archivePath=None):
+        """ Move logs older than days to the archive folder
+        (by default 'logs-archive' inside the data path).
+        See DataLog.archive_logs.
+        """
+        archivePath = archivePath or os.path.join(self._dataPath,
+                                                  'logs-archive')
+        return self._db_log.archive_logs(archivePath, days=days)
 
     # ------------------------- USERS ----------------------------------
     def create_admin(self, password='admin'):
@@ -102,11 +150,13 @@ class DataManager(DbManager):
 
         return self.__update_item(self.User, **attrs)
 
-    def get_users(self, condition=None, orderBy=None, asJson=False):
+    def get_users(self, condition=None, orderBy=None, asJson=False,
+                  attrs=None, **kwargs):
         return self.__items_from_query(self.User,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       attrs=attrs, **kwargs)
 
     def get_user_by(self, **kwargs):
         """ This should return a single user or None. """
@@ -119,11 +169,13 @@ class DataManager(DbManager):
     def update_form(self, **attrs):
         return self.__update_item(self.Form, **attrs)
 
-    def get_forms(self, condition=None, orderBy=None, asJson=False):
+    def get_forms(self, condition=None, orderBy=None, asJson=False,
+                  attrs=None, **kwargs):
         return self.__items_from_query(self.Form,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       attrs=attrs, **kwargs)
 
     def get_form_by(self, **kwargs):
         """ This should return a single Form or None. """
@@ -146,11 +198,13 @@ class DataManager(DbManager):
     def update_resource(self, **attrs):
         return self.__update_item(self.Resource, **attrs)
 
-    def get_resources(self, condition=None, orderBy=None, asJson=False):
+    def get_resources(self, condition=None, orderBy=None, asJson=False,
+                      attrs=None, **kwargs):
         return self.__items_from_query(self.Resource,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       attrs=attrs, **kwargs)
 
     def get_resource_by(self, **kwargs):
         """ This should return a single Resource or None. """
@@ -160,11 +214,13 @@ class DataManager(DbManager):
     def create_template(self, **attrs):
         return self.__create_item(self.Template, **attrs)
 
-    def get_templates(self, condition=None, orderBy=None, asJson=False):
+    def get_templates(self, condition=None, orderBy=None, asJson=False,
+                      attrs=None, **kwargs):
         return self.__items_from_query(self.Template,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       attrs=attrs, **kwargs)
 
     def update_template(self, **attrs):
         return self.__update_item(self.Template, **attrs)
@@ -177,11 +233,13 @@ class DataManager(DbManager):
     def create_application(self, **attrs):
         return self.__create_item(self.Application, **attrs)
 
-    def get_applications(self, condition=None, orderBy=None, asJson=False):
+    def get_applications(self, condition=None, orderBy=None, asJson=False,
+                         attrs=None, **kwargs):
         return self.__items_from_query(self.Application,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       attrs=attrs, **kwargs)
 
     def get_application_by(self, **kwargs):
         """ This should return a single user or None. """
@@ -275,24 +333,34 @@ class DataManager(DbManager):
         repeat_value = attrs.get('repeat_value', 'no')
         modify_all = attrs.pop('modify_all', None)
         bookings = []
+        # Index used to validate all bookings of this batch, new ones will be
+        # added to it, so repeating bookings are also checked between them
+        index = BookingsIndex(self.__load_resource_bookings)
 
         def _add_booking(attrs):
             b = self.__create_booking(attrs,
                                       check_min_booking=check_min_booking,
-                                      check_max_booking=check_max_booking)
+                                      check_max_booking=check_max_booking,
+                                      index=index)
+            self.__update_usage(b)
             bookings.append(b)
 
-        if repeat_value == 'no':
-            _add_booking(attrs)
-        else:
-            repeat_stop = attrs.pop('repeat_stop')
-            repeater = RepeatRanges(repeat_value, attrs)
-            uid = str(uuid.uuid4())
-
-            while attrs['end'] < repeat_stop:
-                attrs['repeat_id'] = uid
+        try:
+            if repeat_value == 'no':
                 _add_booking(attrs)
-                repeater.move()  # will move next start,end in attrs
+            else:
+                repeat_stop = attrs.pop('repeat_stop')
+                repeater = RepeatRanges(repeat_value, attrs)
+                uid = str(uuid.uuid4())
+
+                while attrs['end'] < repeat_stop:
+                    attrs['repeat_id'] = uid
+                    _add_booking(attrs)
+                    repeater.move()  # will move next start,end in attrs
+        except Exception:
+            # Discard usage changes from the bookings validated so far
+            self._db_session.rollback()
+            raise
 
         # Insert all created bookings
         for b in bookings:
@@ -319,9 +387,11 @@ class DataManager(DbManager):
         """
         repeat = attrs.get('repeat_value', 'no')
         repeater = RepeatRanges(repeat, attrs) if repeat != 'no' else None
+        index = BookingsIndex(self.__load_resource_bookings)
 
         def update(b):
             self.__check_cancellation(b)
+            self.__update_usage(b, -1)
 
             for attr, value in attrs.items():
                 if attr != 'id':
@@ -329,7 +399,8 @@ class DataManager(DbManager):
             if repeater:
                 repeater.move()  # move start, end for repeating bookings
 
-            self.__validate_booking(b)
+            self.__validate_booking(b, index=index)
+            self.__update_usage(b)
 
         result = self._modify_bookings(attrs, update)
 
@@ -338,37 +409,48 @@ class DataManager(DbManager):
 
         return result
 
-    def get_bookings(self, condition=None, orderBy=None, asJson=False):
+    def get_bookings(self, condition=None, orderBy=None, asJson=False,
+                     attrs=None, profile=None, **kwargs):
+        """ Retrieve bookings, optionally filtered and sorted.
+
+        Keyword Args:
+            profile: name of the loading profile (see BOOKING_PROFILES)
+                used to eagerly load related objects, e.g. 'event' when
+                the bookings will be converted to calendar events.
+            Pagination (limit, after_id, after_start) and iterate
+            arguments are the same for all get_* methods.
+        """
         return self.__items_from_query(self.Booking,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
-
-    def get_bookings_range(self, start, end, resource=None):
-        """ Shortcut function to retrieve a range of bookings. """
-        # JMRT: For some reason the retrieval of the date ranges is not working
-        # as expected for the time. So we are taking on day before for the start
-        # and one day after for the end and filter later
-        newStart = (start - dt.timedelta(days=1)).replace(hour=23, minute=59)
-        newEnd = (end + dt.timedelta(days=1)).replace(hour=0, minute=0)
-        rangeStr = datetime_to_isoformat(newStart), datetime_to_isoformat(newEnd)
-
-        startBetween = "(start>='%s' AND start<='%s')" % rangeStr
-        endBetween = "(end>='%s' AND end<='%s')" % rangeStr
-        rangeOver = "(start<='%s' AND end>='%s')" % rangeStr
-        conditionStr = "(%s OR %s OR %s)" % (startBetween, endBetween, rangeOver)
+                                       asJson=asJson,
+                                       attrs=attrs,
+                                       options=self.__booking_options(profile),
+                                       **kwargs)
+
+    def get_bookings_range(self, start, end, resource=None, resource_ids=None,
+                           profile=None):
+        """ Shortcut function to retrieve a range of bookings.
+        All bookings overlapping with the [start, end] interval will be
+        returned, sorted by start. Both start and end should be timezone
+        aware datetimes, they are normalized to UTC when compared with the
+        stored values. Bookings can be restricted to a given resource or
+        to a list of resource_ids. The profile argument is the same as
+        in get_bookings.
+        """
+        Booking = self.Booking
+        query = self._db_session.query(Booking).options(
+            *self.__booking_options(profile))
 
         if resource is not None:
-            conditionStr += " AND resource_id=%s" % resource.id
+            query = query.filter(Booking.resource_id == resource.id)
 
-        def in_range(b):
-            s, e = b.start, b.end
-            return ((s >= start and s <= end) or
-                    (e >= start and e <= end) or
-                    (s <= start and e >= end))
+        if resource_ids:
+            query = query.filter(Booking.resource_id.in_(resource_ids))
 
-        return [b for b in self.get_bookings(condition=conditionStr, orderBy='start')
-                if in_range(b)]
+        query = query.filter(Booking.start <= end, Booking.end >= start)
+
+        return query.order_by(Booking.start).all()
 
     def delete_booking(self, **attrs):
         """ Delete one or many bookings (in case of repeating events)
@@ -380,6 +462,7 @@ class DataManager(DbManager):
         """
         def delete(b):
             self.__check_cancellation(b)
+            self.__update_usage(b, -1)
             self.delete(b, commit=False)
 
         result = self._modify_bookings(attrs, delete)
@@ -397,26 +480,61 @@ class DataManager(DbManager):
                                 resource_ids=None, resource_tags=None):
         """ Count how many days has been used by applications from the
         current bookings. The count can be done by resources or by tags.
+        Days are taken from the ApplicationUsage ledger, that is updated
+        every time that bookings are created, updated or deleted.
         """
         application_ids = set(a for a in applications)
         count_dict = defaultdict(lambda: defaultdict(lambda: 0))
 
-        for b in self.get_bookings():
-            if b.application is None:
-                continue
+        Usage = self.ApplicationUsage
+        query = self._db_session.query(Usage)
+        query = query.filter(Usage.application_id.in_(application_ids))
+        usages = [u for u in query if u.days]
+
+        if resource_tags is not None:
+            resources = {r.id: r for r in self.get_resources()}
 
-            baid = b.application.id
-            if baid in application_ids:
-                rid = b.resource.id
-                if resource_tags is not None:
-                    for tag in resource_tags:
-                        if tag in b.resource.tags:
-                            count_dict[baid][tag] += b.days
-                elif not resource_ids or rid in resource_ids:
-                    count_dict[baid][rid] += b.days
+        for u in usages:
+            aid, rid = u.application_id, u.resource_id
+            if resource_tags is not None:
+                for tag in resource_tags:
+                    if tag in resources[rid].tags:
+                        count_dict[aid][tag] += u.days
+            elif not resource_ids or rid in resource_ids:
+                count_dict[aid][rid] += u.days
 
         return count_dict
 
+    def rebuild_usage(self):
+        """ Recompute the ApplicationUsage ledger from all bookings.
+        Return:
+            a list of tuples (application_id, resource_id, stored_days, days)
+            for all entries where the stored value was wrong.
+        """
+        expected = defaultdict(lambda: 0)
+
+        for b in self.get_bookings():
+            if b.application_id is not None and b.resource_id is not None:
+                expected[(b.application_id, b.resource_id)] += b.days
+
+        drift = []
+        Usage = self.ApplicationUsage
+        for u in self._db_session.query(Usage):
+            key = (u.application_id, u.resource_id)
+            days = expected.pop(key, 0)
+            if u.days != days:
+                drift.append(key + (u.days, days))
+                u.days = days
+
+        for key, days in expected.items():
+            drift.append(key + (0, days))
+            self._db_session.add(Usage(application_id=key[0],
+                                       resource_id=key[1],
+                                       days=days))
+        self.commit()
+
+        return drift
+
     # ---------------------------- SESSIONS -----------------------------------
     def __get_section(self, sectionName):
         formDef = self.get_form_by_name('sessions_config').definition
@@ -484,7 +602,7 @@ class DataManager(DbManager):
         """ Return the name for the new session, base on the booking and
         the previous sessions counter (stored in Form 'counters').
         """
-        b = self.get_bookings(condition="id=%s" % booking_id)[0]
+        b = self.get_bookings(condition={'id': booking_id})[0]
         a = b.application
         code = 'fac' if a is None else a.code.lower()
         sep = '' if len(code) == 3 else '_'
@@ -496,14 +614,17 @@ class DataManager(DbManager):
             'name': '%s%s%05d' % (code, sep, c)
         }
 
-    def get_sessions(self, condition=None, orderBy=None, asJson=False):
+    def get_sessions(self, condition=None, orderBy=None, asJson=False,
+                     attrs=None, **kwargs):
         """ Returns a list.
-        condition example: text("id<:value and name=:name")
+        condition example: {"field": "id", "op": "<", "value": 10}
+        (see data_filter) or the legacy string form "id<10 and name='x'"
         """
         return self.__items_from_query(self.Session,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       attrs=attrs, **kwargs)
 
     def get_session_by(self, **kwargs):
         """ This should return a single Session or None. """
@@ -512,7 +633,7 @@ class DataManager(DbManager):
     def create_session(self, **attrs):
         """ Add a new session row. """
         create_data = attrs.pop('create_data', False)
-        b = self.get_bookings(condition="id=%s" % attrs['booking_id'])[0]
+        b = self.get_bookings(condition={'id': attrs['booking_id']})[0]
         attrs['resource_id'] = b.resource.id
         attrs['operator_id'] = b.owner.id if b.operator is None else b.operator.id
 
@@ -541,6 +662,8 @@ class DataManager(DbManager):
         self.update_session_counter(session_info['code'],
                                     session_info['counter'] + 1)
 
+        self.events.publish('session_created', {'session_id': session.id,
+                                                'status': session.status})
         return session
 
     def update_session(self, **attrs):
@@ -561,6 +684,8 @@ class DataManager(DbManager):
         if c < counter:
             self.update_session_counter(code, counter + 1)
 
+        self.events.publish('session_updated', {'session_id': session.id,
+                                                'status': session.status})
         return session
 
     def delete_session(self, **attrs):
@@ -568,6 +693,7 @@ class DataManager(DbManager):
         sessionId = attrs['id']
         session = self.Session.query.get(sessionId)
         data_path = self._session_data_path(session)
+        self._sessionsCache.discard(data_path)
         self.delete(session)
 
         if os.path.exists(data_path):
@@ -576,27 +702,31 @@ class DataManager(DbManager):
         self.log("operation", "delete_Session",
                  attrs=self.json_from_dict(attrs))
 
+        self.events.publish('session_deleted', {'session_id': sessionId})
         return session
 
     def load_session(self, sessionId, mode="r"):
-        # if self._lastSession is not None:
-        #     if self._lastSession.id == sessionId:
-        #         return self._lastSession
-        #     self._lastSession.data.close()
-
+        """ Load the session and its data file. The file is taken from
+        the cache of open files, session.data.close() should be called
+        after using it.
+        """
         session = self.Session.query.get(sessionId)
-        session.data = H5SessionData(self._session_data_path(session), mode)
+        session.data = self._sessionsCache.acquire(
+            self._session_data_path(session), mode)
         return session
 
     # -------------------------- INVOICE PERIODS ------------------------------
-    def get_invoice_periods(self, condition=None, orderBy=None, asJson=False):
+    def get_invoice_periods(self, condition=None, orderBy=None, asJson=False,
+                            attrs=None, **kwargs):
         """ Returns a list.
-        condition example: text("id<:value and name=:name")
+        condition example: {"field": "id", "op": "<", "value": 10}
+        (see data_filter) or the legacy string form "id<10 and name='x'"
         """
         return self.__items_from_query(self.InvoicePeriod,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       attrs=attrs, **kwargs)
 
     def create_invoice_period(self, **attrs):
         """ Add a new session row. """
@@ -622,14 +752,17 @@ class DataManager(DbManager):
         return self.__item_by(self.InvoicePeriod, **kwargs)
 
     # ---------------------------- TRANSACTIONS -------------------------------
-    def get_transactions(self, condition=None, orderBy=None, asJson=False):
+    def get_transactions(self, condition=None, orderBy=None, asJson=False,
+                         attrs=None, **kwargs):
         """ Returns a list.
-        condition example: text("id<:value and name=:name")
+        condition example: {"field": "id", "op": "<", "value": 10}
+        (see data_filter) or the legacy string form "id<10 and name='x'"
         """
         return self.__items_from_query(self.Transaction,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       attrs=attrs, **kwargs)
 
     def create_transaction(self, **attrs):
         """ Add a new session row. """
@@ -665,17 +798,131 @@ class DataManager(DbManager):
         return new_item
 
     def __items_from_query(self, ModelClass,
-                           condition=None, orderBy=None, asJson=False):
+                           condition=None, orderBy=None, asJson=False,
+                           attrs=None, options=None, limit=None,
+                           after_id=None, after_start=None, iterate=False):
+        """ Query items of the given model.
+
+        If asJson is True and attrs is provided, only these columns will
+        be selected and serialized, instead of loading the whole objects.
+
+        Keyset pagination:
+            limit: maximum number of items to return.
+            after_id: only return items after this id (sorted by id).
+            after_start: only return items after this start (sorted by
+                start and then by id). The id of the last item in the
+                previous page should also be passed as after_id.
+
+        If iterate is True, a generator is returned instead of a list
+        and items are fetched from the DB in batches.
+        """
         query = self._db_session.query(ModelClass)
+        columns = self.__projection(ModelClass, attrs) if asJson else None
+
+        if columns:
+            query = query.with_entities(*columns)
+        elif options:
+            query = query.options(*options)
 
         if condition is not None:
-            query = query.filter(sqlalchemy.text(condition))
+            if isinstance(condition, str):  # Legacy raw SQL condition
+                query = query.filter(sqlalchemy.text(condition))
+            else:
+                expr, params = compile_filter(ModelClass, condition)
+                query = query.filter(expr).params(**params)
 
-        if orderBy is not None:
+        if limit is not None or after_id is not None or after_start is not None:
+            query = self.__keyset_page(ModelClass, query, orderBy,
+                                       limit, after_id, after_start)
+        elif orderBy is not None:
             query = query.order_by(orderBy)
 
-        result = query.all()
-        return [s.json() for s in result] if asJson else result
+        if columns:
+            def _json(row):
+                return {c.key: self.json_from_value(v)
+                        for c, v in zip(columns, row)}
+        elif asJson:
+            def _json(item):
+                return item.json()
+        else:
+            def _json(item):
+                return item
+
+        if iterate:
+            return (_json(item) for item in query.yield_per(500))
+
+        return [_json(item) for item in query.all()]
+
+    def __keyset_page(self, ModelClass, query, orderBy,
+                      limit, after_id, after_start):
+        """ Sort and filter the query to retrieve a single page. """
+        by_start = after_start is not None or orderBy == 'start'
+
+        if orderBy not in [None, 'id', 'start']:
+            raise Exception("Pagination only allowed ordering by "
+                            "'id' or 'start', not '%s'" % orderBy)
+
+        if by_start and 'start' not in ModelClass.__table__.columns:
+            raise Exception("Can not paginate %s by 'start'"
+                            % ModelClass.__name__)
+
+        if by_start:
+            query = query.order_by(ModelClass.start, ModelClass.id)
+            if after_start is not None:
+                if isinstance(after_start, str):
+                    after_start = datetime_from_isoformat(after_start)
+                cond = ModelClass.start > after_start
+                if after_id is not None:
+                    cond = sqlalchemy.or_(
+                        cond, sqlalchemy.and_(ModelClass.start == after_start,
+                                              ModelClass.id > after_id))
+                query = query.filter(cond)
+        else:
+            query = query.order_by(ModelClass.id)
+            if after_id is not None:
+                query = query.filter(ModelClass.id > after_id)
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        return query
+
+    def __projection(self, ModelClass, attrs):
+        """ Return the list of columns to be selected for the given attrs.
+        None is returned if some attribute is not a column (e.g. pi_list
+        of Applications) and the whole objects need to be loaded.
+        """
+        if not attrs:
+            return None
+
+        table_columns = ModelClass.__table__.columns
+        if any(a not in table_columns for a in attrs):
+            return None
+
+        return [table_columns[a] for a in attrs]
+
+    def __booking_options(self, profile):
+        """ Return the query options to eagerly load the relations
+        needed by the given bookings profile.
+        """
+        if profile is None:
+            return []
+
+        if profile not in self.BOOKING_PROFILES:
+            raise Exception("Unknown bookings profile '%s'" % profile)
+
+        Booking = self.Booking
+        options = []
+        for path in self.BOOKING_PROFILES[profile]:
+            attrs = path.split('.')
+            opt = joinedload(getattr(Booking, attrs[0]))
+            Model = getattr(Booking, attrs[0]).property.mapper.class_
+            for a in attrs[1:]:
+                opt = opt.joinedload(getattr(Model, a))
+                Model = getattr(Model, a).property.mapper.class_
+            options.append(opt)
+
+        return options
 
     def __item_by(self, ModelClass, **kwargs):
         query = self._db_session.query(ModelClass)
@@ -747,22 +994,24 @@ class DataManager(DbManager):
                     raise Exception("The duration of the booking is greater that "
                                     "the maximum allowed for the resource. ")
 
-        overlap = self.get_bookings_range(booking.start,
-                                          booking.end,
-                                          resource=r)
+        index = kwargs.get('index', None)
+        if index is None:
+            index = BookingsIndex(self.__load_resource_bookings)
+
+        overlap = index.overlap(r.id, booking.start, booking.end)
 
         app = None
 
         if not booking.is_slot:
             # Check there is not overlapping with other non-slot events
             overlap_noslots = [b for b in overlap
-                               if not b.is_slot and b.id != booking.id]
+                               if not b.is_slot and b is not booking]
             if overlap_noslots:
                 raise Exception("Booking is overlapping with other events: %s"
                                 % overlap_noslots)
 
             overlap_slots = [b for b in overlap
-                             if b.is_slot and b.id != booking.id]
+                             if b.is_slot and b is not booking]
 
             # Always try to find the Application to set in the booking unless
             # the owner is a manager
@@ -818,6 +1067,38 @@ class DataManager(DbManager):
         else:
             booking.application_id = None
 
+        # Keep the index updated with the new booking values
+        index.add(booking)
+
+    def __update_usage(self, booking, sign=1):
+        """ Add (or subtract if sign=-1) the days of this booking to the
+        usage of its Application on the booked Resource.
+        """
+        if booking.application_id is None or booking.resource_id is None:
+            return
+
+        Usage = self.ApplicationUsage
+        key = (int(booking.application_id), int(booking.resource_id))
+        usage = self._db_session.query(Usage).get(key)
+
+        if usage is None:
+            usage = Usage(application_id=key[0], resource_id=key[1], days=0)
+            self._db_session.add(usage)
+            # Flush, so the new entry is found in next queries
+            self._db_session.flush()
+
+        usage.days += sign * booking.days
+
+    def __load_resource_bookings(self, resource_id, since):
+        """ Load bookings of a given resource that end after 'since'.
+        Used to build the BookingsIndex.
+        """
+        Booking = self.Booking
+        query = self._db_session.query(Booking)
+        query = query.filter(Booking.resource_id == resource_id,
+                             Booking.end >= since)
+        return query.all()
+
     def __check_cancellation(self, booking):
         """ Check if this booking can be updated or deleted.
         Normal users can only delete or modify the booking up to X hours
@@ -851,7 +1132,7 @@ class DataManager(DbManager):
         modify_all = attrs.pop('modify_all', False)
 
         # Get the booking with the given id
-        bookings = self.get_bookings(condition='id="%s"' % booking_id)
+        bookings = self.get_bookings(condition={'id': booking_id})
 
         if not bookings:
             raise Exception("There is no booking with ID=%s" % booking_id)
@@ -863,7 +1144,7 @@ class DataManager(DbManager):
 
         if rid is not None:
             repeats = [
-                b for b in self.get_bookings(condition='repeat_id="%s"' % rid)
+                b for b in self.get_bookings(condition={'repeat_id': rid})
                 if b.start > booking.start
             ]
             if modify_all:
@@ -878,8 +1159,12 @@ class DataManager(DbManager):
                 for b in repeats:
                     b.repeat_id = uid
 
-        for b in result:
-            modifyFunc(b)
+        try:
+            for b in result:
+                modifyFunc(b)
+        except Exception:
+            self._db_session.rollback()
+            raise
 
         self.commit()
 
@@ -907,3 +1192,79 @@ class RepeatRanges:
         self._attrs['start'] += self._delta
         self._attrs['end'] += self._delta
 
+
+class BookingsIndex:
+    """ In-memory index of bookings per resource, used to validate overlapping
+    of many bookings (e.g. repeating events) without querying the database
+    for each one of them.
+
+    For each resource, bookings are kept sorted by start. Since the longest
+    duration is also stored, the overlapping bookings with a given range
+    are found with a binary search.
+    """
+    def __init__(self, loader):
+        """
+        Args:
+            loader: function (resource_id, since) that returns the stored
+                bookings of a resource that end after 'since'.
+        """
+        self._loader = loader
+        self._resources = {}
+
+    def __get_entry(self, resource_id, since):
+        """ Return the index entry for the given resource, loading bookings
+        from the loader if the 'since' date is not covered yet.
+        """
+        entry = self._resources.get(resource_id, None)
+
+        if entry is None:
+            entry = {'since': since, 'starts': [], 'bookings': [],
+                     'keys': {}, 'max_duration': dt.timedelta(0)}
+            self._resources[resource_id] = entry
+            load = True
+        else:
+            load = since < entry['since']
+
+        if load:
+            entry['since'] = min(since, entry['since'])
+            for b in self._loader(resource_id, since):
+                if b not in entry['keys']:
+                    self.__insert(entry, b)
+
+        return entry
+
+    def __insert(self, entry, booking):
+        i = bisect_right(entry['starts'], booking.start)
+        entry['starts'].insert(i, booking.start)
+        entry['bookings'].insert(i, booking)
+        entry['keys'][booking] = booking.start
+        entry['max_duration'] = max(entry['max_duration'], booking.duration)
+
+    def __remove(self, entry, booking):
+        key = entry['keys'].pop(booking)
+        i = bisect_left(entry['starts'], key)
+        while entry['bookings'][i] is not booking:
+            i += 1
+        del entry['starts'][i]
+        del entry['bookings'][i]
+
+    def add(self, booking):
+        """ Add a booking to the index, or update its position if it was
+        already there (e.g. start or end were modified).
+        """
+        entry = self.__get_entry(int(booking.resource_id), booking.start)
+        if booking in entry['keys']:
+            self.__remove(entry, booking)
+        self.__insert(entry, booking)
+
+    def overlap(self, resource_id, start, end):
+        """ Return the bookings of the given resource overlapping
+        with the [start, end] range, sorted by start.
+        """
+        entry = self.__get_entry(resource_id, start)
+        starts = entry['starts']
+        first = bisect_left(starts, start - entry['max_duration'])
+        last = bisect_right(starts, end)
+
+        return [b for b in entry['bookings'][first:last]
+                if b.start <= end and b.end >= start]
@@ -30,7 +30,7 @@ import datetime as dt
 import jwt
 
 from sqlalchemy import (Column, Integer, String, JSON,
-                        ForeignKey, Text, Table, Float)
+                        ForeignKey, Text, Table, Float, Index)
 from sqlalchemy.orm import relationship
 from sqlalchemy_utc import UtcDateTime, utcnow
 from flask_login import UserMixin
@@ -513,6 +513,13 @@ def create_data_models(dm):
     class Booking(Base):
         """Model for user accounts."""
         __tablename__ = 'bookings'
+        # Indexes used by the range (overlapping) queries, with and
+        # without filtering by resource
+        __table_args__ = (
+            Index('ix_bookings_resource_start_end',
+                  'resource_id', 'start', 'end'),
+            Index('ix_bookings_end_start', 'end', 'start'),
+        )
 
         id = Column(Integer,
                     primary_key=True)
@@ -653,6 +660,26 @@ def create_data_models(dm):
             return application.code in self.slot_auth.get('applications', [])
 
 
+    class ApplicationUsage(Base):
+        """ Number of days booked by an Application on a given Resource.
+        This ledger is updated when bookings are created, updated or
+        deleted, so the usage can be checked without counting over
+        all bookings.
+        """
+        __tablename__ = 'application_usage'
+
+        application_id = Column(Integer, ForeignKey('applications.id'),
+                                primary_key=True)
+
+        resource_id = Column(Integer, ForeignKey('resources.id'),
+                             primary_key=True)
+
+        days = Column(Integer, nullable=False, default=0)
+
+        def json(self):
+            return dm.json_from_object(self)
+
+
     class Session(Base):
         """Model for sessions."""
         __tablename__ = 'sessions'
@@ -839,6 +866,7 @@ def create_data_models(dm):
     dm.Template = Template
     dm.Application = Application
     dm.Booking = Booking
+    dm.ApplicationUsage = ApplicationUsage
     dm.Session = Session
     dm.Transaction = Transaction
     dm.InvoicePeriod = InvoicePeriod
@@ -27,7 +27,13 @@
 # **************************************************************************
 
 import os
-from collections import namedtuple
+import ast
+import time
+import hashlib
+import operator
+import threading
+from functools import lru_cache
+from collections import namedtuple, OrderedDict
 import numpy as np
 import h5py
 import sqlite3
@@ -36,6 +42,242 @@ import tables as tbl
 from emhub.utils import image
 
 
+_CONDITION_OPS = {
+    ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    ast.Add: operator.add, ast.Sub: operator.sub,
+    ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.USub: operator.neg,
+    ast.In: np.isin,
+    ast.NotIn: lambda a, b: np.logical_not(np.isin(a, b)),
+}
+
+
+@lru_cache(maxsize=256)
+def parse_condition(condition):
+    """ Parse a condition string (e.g 'ctfResolution < 4 and ctfFit > 0.1')
+    and return the expression tree and the names of the used attributes.
+
+    Only comparisons, arithmetic, 'and', 'or', 'not', 'in' with a
+    list of constants, attribute names and constants are allowed.
+    """
+    try:
+        tree = ast.parse(condition, mode='eval').body
+    except SyntaxError:
+        raise Exception("Invalid condition: %s" % condition)
+
+    names = set()
+
+    def _check(node):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, (ast.List, ast.Tuple)):
+            if not all(isinstance(e, ast.Constant) for e in node.elts):
+                raise Exception("Only constants are allowed in lists.")
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float, str)):
+                raise Exception("Invalid constant: %s" % node.value)
+        elif isinstance(node, (ast.BoolOp, ast.Compare,
+                               ast.UnaryOp, ast.BinOp)):
+            for op in ast.walk(node):
+                if (isinstance(op, (ast.operator, ast.unaryop, ast.cmpop))
+                        and type(op) not in _CONDITION_OPS
+                        and not isinstance(op, ast.Not)):
+                    raise Exception("Invalid operator in condition: %s"
+                                    % type(op).__name__)
+            for child in ast.iter_child_nodes(node):
+                if not isinstance(child, (ast.boolop, ast.operator,
+                                          ast.unaryop, ast.cmpop)):
+                    _check(child)
+        else:
+            raise Exception("Invalid expression in condition: %s"
+                            % type(node).__name__)
+
+    _check(tree)
+    return tree, frozenset(names)
+
+
+def eval_condition(condition, getColumn):
+    """ Evaluate the condition over all rows at once.
+
+    Args:
+        condition: condition string, see parse_condition.
+        getColumn: function that returns a numpy array with the
+            values of a given attribute for all rows.
+    Return:
+        A boolean numpy array with the rows that match the condition.
+        Missing values (NaN) never match a comparison.
+    """
+    tree, names = parse_condition(condition)
+    columns = {name: getColumn(name) for name in names}
+
+    def _eval(node):
+        if isinstance(node, ast.Name):
+            return columns[node.id]
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [e.value for e in node.elts]
+        if isinstance(node, ast.BoolOp):
+            func = (np.logical_and if isinstance(node.op, ast.And)
+                    else np.logical_or)
+            result = _eval(node.values[0])
+            for v in node.values[1:]:
+                result = func(result, _eval(v))
+            return result
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.Not):
+                return np.logical_not(_eval(node.operand))
+            return _CONDITION_OPS[type(node.op)](_eval(node.operand))
+        if isinstance(node, ast.BinOp):
+            return _CONDITION_OPS[type(node.op)](_eval(node.left),
+                                                 _eval(node.right))
+        # Compare, chained comparisons like 1 < id <= 10 are allowed
+        result, left = True, _eval(node.left)
+        for op, comp in zip(node.ops, node.comparators):
+            right = _eval(comp)
+            result = np.logical_and(result,
+                                    _CONDITION_OPS[type(op)](left, right))
+            left = right
+        return result
+
+    with np.errstate(invalid='ignore'):
+        return np.asarray(_eval(tree), dtype=bool)
+
+
+def select_rows(size, getColumn, condition=None, orderBy=None, limit=None):
+    """ Return the indexes of the rows matching the condition, sorted
+    by the orderBy attribute (e.g 'ctfResolution' or 'ctfFit desc')
+    and limited to the first 'limit' rows.
+    """
+    rows = np.arange(size)
+
+    if condition:
+        rows = np.nonzero(eval_condition(condition, getColumn))[0]
+
+    if orderBy:
+        parts = orderBy.split()
+        if len(parts) > 2 or (len(parts) == 2
+                              and parts[1].lower() not in ['asc', 'desc']):
+            raise Exception("Invalid orderBy: %s" % orderBy)
+        key = np.asarray(getColumn(parts[0]))[rows]
+        if len(parts) == 2 and parts[1].lower() == 'desc':
+            # Keep missing values (NaN) at the end also in reverse order
+            order = (np.argsort(-key, kind='stable')
+                     if np.issubdtype(key.dtype, np.number)
+                     else np.argsort(key, kind='stable')[::-1])
+        else:
+            order = np.argsort(key, kind='stable')
+        rows = rows[order]
+
+    if limit is not None:
+        rows = rows[:int(limit)]
+
+    return rows
+
+
+class SetStats:
+    """ Running statistics of the values of an attribute in a set:
+    count, min, max, mean, variance (Welford) and a histogram.
+
+    The histogram has a fixed number of fine bins. When a value falls out
+    of its range, the bins width is doubled (merging pairs of bins) until
+    the value fits, so the histogram never needs the previous values.
+    Histograms with fewer bins are computed from the fine ones on read.
+    """
+    NUM_BINS = 512
+    KEYS = ['count', 'min', 'max', 'mean', 'm2', 'start', 'width', 'hist']
+
+    def __init__(self, **kwargs):
+        self.count = kwargs.get('count', 0)
+        self.min = kwargs.get('min', np.nan)
+        self.max = kwargs.get('max', np.nan)
+        self.mean = kwargs.get('mean', 0.0)
+        self.m2 = kwargs.get('m2', 0.0)
+        self.start = kwargs.get('start', 0.0)
+        self.width = kwargs.get('width', 0.0)
+        self.hist = np.zeros(self.NUM_BINS, dtype=np.int64)
+        if 'hist' in kwargs:
+            self.hist[:] = kwargs['hist']
+
+    def add(self, values):
+        """ Add one or many values, missing values (NaN) are ignored. """
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        values = values[np.isfinite(values)]
+        n = len(values)
+        if n == 0:
+            return
+
+        lo, hi = values.min(), values.max()
+        self._fitRange(lo, hi)
+        bins = ((values - self.start) / self.width).astype(np.int64)
+        self.hist += np.bincount(np.clip(bins, 0, self.NUM_BINS - 1),
+                                 minlength=self.NUM_BINS)
+
+        # Merge the mean and variance of the new values (Chan et al.)
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.min = lo if self.count == n else min(self.min, lo)
+        self.max = hi if self.count == n else max(self.max, hi)
+
+    def _fitRange(self, lo, hi):
+        if self.count == 0:
+            self.start = lo
+            self.width = (hi - lo or max(abs(lo), 1.0)) * 2 / self.NUM_BINS
+            return
+
+        half = self.NUM_BINS // 2
+        while lo < self.start or hi >= self.start + self.width * self.NUM_BINS:
+            merged = self.hist.reshape(half, 2).sum(axis=1)
+            self.hist[:] = 0
+            if lo < self.start:  # Extend the range to the left
+                self.hist[half:] = merged
+                self.start -= self.width * self.NUM_BINS
+            else:
+                self.hist[:half] = merged
+            self.width *= 2
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    def histogram(self, bins=10):
+        """ Return the histogram (counts, edges) with the given number
+        of bins between the min and max values.
+        """
+        if self.count == 0:
+            return np.zeros(bins, dtype=np.int64), np.zeros(bins + 1)
+        centers = self.start + self.width * (np.arange(self.NUM_BINS) + 0.5)
+        centers = np.clip(centers, self.min, self.max)
+        return np.histogram(centers, bins=bins, range=(self.min, self.max),
+                            weights=self.hist)
+
+    def toDict(self):
+        return {k: getattr(self, k) for k in self.KEYS}
+
+    def json(self, bins=10):
+        hist, edges = self.histogram(bins)
+
+        def _float(v):
+            return float(v) if self.count else None
+
+        return {
+            'count': int(self.count),
+            'min': _float(self.min),
+            'max': _float(self.max),
+            'mean': _float(self.mean),
+            'std': _float(np.sqrt(self.variance)),
+            'hist': [int(h) for h in hist],
+            'bins': [float(e) for e in edges]
+        }
+
+
 class SessionData:
     """
     Class that will handle the underlying data associate with a given Session.
@@ -48,7 +290,8 @@ class SessionData:
         Args:
             attrList: An optional list of attributes, to avoid returning
                 all properties for each set. If None, only id's will be returned.
-            condition: An optional condition string to filter out the result.
+            condition: An optional condition string to filter out the result
+                (e.g 'id > 1'), see parse_condition.
         """
         pass
 
@@ -64,7 +307,8 @@ class SessionData:
         """
         pass
 
-    def get_set_items(self, setId, attrList=None, condition=None):
+    def get_set_items(self, setId, attrList=None, condition=None,
+                      orderBy=None, limit=None):
         """ Return a list with all or some items from this set.
 
         Args:
@@ -73,6 +317,10 @@ class SessionData:
                 all properties for each set. (e.g 'id')
             condition: An optional condition string to filter out
                 the result list of objects
+                (e.g 'ctfResolution < 4 and ctfFit > 0.1').
+            orderBy: Optional attribute to sort the items, followed
+                by 'desc' for descending order (e.g 'ctfFit desc').
+            limit: Maximum number of items to return.
         Return:
             A list with items (dict objects)
         """
@@ -81,18 +329,87 @@ class SessionData:
     def get_set_item(self, setId, itemId, attrList=None):
         pass
 
+    def get_set_item_hash(self, setId, itemId, key):
+        """ Return a hash of the image (or other binary data) of the item,
+        that changes when the image is updated, or None if there is none.
+        """
+        data = self.get_set_item(setId, itemId, [key])[key]
+        return hashlib.md5(data).hexdigest() if data else None
+
     def add_set_item(self, setId, itemId, attrDict):
         pass
 
     def update_set_item(self, setId, itemId, attrDict):
         pass
 
+    def add_set_items(self, setId, items):
+        """ Add several items to the set.
+
+        Args:
+            setId: The id of the set containing the items.
+            items: List of dicts with the 'id' of each item and
+                the other attributes.
+        """
+        for item in items:
+            attrs = dict(item)
+            self.add_set_item(setId, attrs.pop('id'), attrs)
+
+    def update_set_items(self, setId, items):
+        """ Update several items of the set, items are given as in
+        add_set_items.
+        """
+        for item in items:
+            attrs = dict(item)
+            self.update_set_item(setId, attrs.pop('id'), attrs)
+
+    def get_set_stats(self, setId, attrList):
+        """ Return a dict with the SetStats of the given numeric
+        attributes of the set items. This default implementation reads
+        all values, subclasses can store the stats while adding items.
+        """
+        items = self.get_set_items(setId, attrList=attrList)
+        stats = {}
+        for a in attrList:
+            stats[a] = SetStats()
+            stats[a].add([np.nan if i[a] is None else i[a] for i in items])
+        return stats
+
 
 class H5SessionData(SessionData):
     """
     Container of Session Data based on HDF5 file.
+
+    Scalar values of the items in a set are stored as columns: one
+    resizable dataset per attribute inside the set 'columns' group, where
+    the 'id' column contains the id of the item in each row. Other values
+    (e.g images) are stored in a group per item. Files where all values
+    are stored in the item groups (old layout) can still be read.
+
+    The SetStats of numeric columns are kept updated in the set 'stats'
+    group, one group per attribute with the stats values as attributes.
     """
-    def __init__(self, h5File, mode='r'):
+    COLUMNS = 'columns'
+    STATS = 'stats'
+    CHUNK_SIZE = 1024
+    # Type and missing value of the numeric columns for each kind of
+    # values, from the narrowest to the widest one
+    COLUMN_TYPES = {
+        'bool': (np.int8, -1),
+        'int': (np.int64, np.iinfo(np.int64).min),
+        'float': (np.float64, np.nan)
+    }
+    NUMERIC_KINDS = list(COLUMN_TYPES)
+    # Seconds to wait for a file locked by another process
+    LOCK_TIMEOUT = 10
+
+    def __init__(self, h5File, mode='r', locking=True):
+        """
+        Args:
+            h5File: path of the HDF5 file.
+            mode: 'r' to read, 'w' to create or 'a' to modify the file.
+            locking: if False, the file is not locked while open, so it
+                does not block other processes (only for reading).
+        """
         #h5py.get_config().track_order = True
         if mode == 'r':
             print("Reading file: ", h5File)
@@ -100,7 +417,12 @@ class H5SessionData(SessionData):
             os.makedirs(os.path.dirname(h5File), exist_ok=True)
             print("Writing file: ", h5File)
 
-        self._file = h5py.File(h5File, mode)
+        self._file = self._openFile(h5File, mode, locking)
+        self._path = h5File
+        self._mode = mode
+        self._cache = None  # Set when opened from a SessionDataCache
+        # Stats computed for files without them, when read only
+        self._computedStats = {}
 
     def get_sets(self, attrList=None, condition=None):
         if attrList is not None and len(attrList) == 0:
@@ -112,6 +434,15 @@ class H5SessionData(SessionData):
             else:
                 setList.append({a: v[a] for a in attrList})
 
+        if condition:
+            groups = list(self._file[self._getSetPath('')].values())
+
+            def _getColumn(name):
+                return np.array([g.attrs.get(name, np.nan) for g in groups])
+
+            rows = select_rows(len(groups), _getColumn, condition)
+            setList = [setList[r] for r in rows]
+
         return setList
 
     def create_set(self, setId, attrDict):
@@ -122,10 +453,29 @@ class H5SessionData(SessionData):
             group.attrs[k] = v
 
     def get_set_item(self, setId, itemId, attrList=None):
-        itemAttrs = self._file[self._getItemPath(setId, itemId)].attrs
-        return {a: itemAttrs[a] for a in attrList}
+        columns = self._getColumns(setId)
+        item = {}
+        itemGroup = self._getItemGroup(setId, itemId)
+
+        row = None if columns is None else self._getRow(columns, itemId)
+
+        for a in attrList:
+            if row is not None and a in columns:
+                item[a] = self._columnValue(columns[a][row],
+                                            self._columnKind(columns[a]))
+            else:
+                item[a] = self._itemValue(itemGroup, a)
+
+        return item
 
-    def get_set_items(self, setId, attrList=None, condition=None):
+    def get_set_item_hash(self, setId, itemId, key):
+        group = self._getItemGroup(setId, itemId)
+        if group is not None and key in group and 'md5' in group[key].attrs:
+            return group[key].attrs['md5'] if group[key].size else None
+        return super().get_set_item_hash(setId, itemId, key)
+
+    def get_set_items(self, setId, attrList=None, condition=None,
+                      orderBy=None, limit=None):
         if attrList is None:
             attrs = list(ImageSessionData.MIC_ATTRS.keys())
         elif 'id' not in attrList:
@@ -137,45 +487,460 @@ class H5SessionData(SessionData):
         if any(a not in ImageSessionData.MIC_ALL_ATTRS for a in attrs):
             raise Exception("Invalid attribute for micrograph")
 
-        itemsList = []
-
         setGroup = self._file[self._getSetPath(setId)]
-        print(self._getSetPath(setId))
+        columns = self._getColumns(setId)
+
+        # Old layout, one group per item with all values as attributes
+        if columns is None:
+            items = list(setGroup.values())
+
+            def _getColumn(name):
+                self._checkConditionAttr(name)
+                return np.array([item.attrs.get(name, np.nan)
+                                 for item in items])
+
+            rows = select_rows(len(items), _getColumn, condition,
+                               orderBy, limit)
+            return [{a: self._itemValue(items[r], a) for a in attrs}
+                    for r in rows]
+
+        # Select the rows evaluating the condition over whole columns
+        # and then read the values only for these rows
+        ids = columns['id'][:]
+        rows = select_rows(len(ids), lambda name: self._getColumn(columns, name),
+                           condition, orderBy, limit)
+        values = {}
+        for a in attrs:
+            if a == 'id':
+                values[a] = [int(i) for i in ids[rows]]
+            elif a in columns:
+                kind = self._columnKind(columns[a])
+                values[a] = [self._columnValue(v, kind)
+                             for v in self._readRows(columns[a], rows)]
+            else:
+                values[a] = [self._itemValue(self._getItemGroup(setId, i), a)
+                             for i in ids[rows]]
 
-        for item in setGroup.values():
-            values = {a: item.attrs[a] for a in attrs}
-            itemsList.append(values)
+        return [{a: values[a][i] for a in attrs} for i in range(len(rows))]
 
-        return itemsList
+    def get_set_column(self, setId, attr):
+        """ Return all values of a column attribute as a numpy array,
+        missing numeric values are NaN.
+        """
+        column = self._getColumns(setId)[attr]
+        if self._columnKind(column) == 'str':
+            return column.asstr()[:]
+        return self._numericColumn(column)
 
     def add_set_item(self, setId, itemId, attrDict):
-        micGroup = self._file.create_group(self._getItemPath(setId, itemId))
-        micAttrs = micGroup.attrs
-        micAttrs['id'] = itemId
+        """ Add a new item to the set. Scalar values are appended to the
+        set columns (one dataset per attribute), while other values
+        (e.g. images) are stored in a group for the item. Images can be
+        passed as bytes or base64 strings, they are stored as binary data.
+        """
+        self.add_set_items(setId, [dict(attrDict, id=itemId)])
 
-        for key, value in attrDict.items():
-            # try:
-                if isinstance(value, np.ndarray):
-                    micGroup.create_dataset(key, data=value)
-                else:
-                    micAttrs[key] = value
-            # except:
-            #     if value is not None:
-            #         #micGroup.create_dataset(key, data=value)
-            #         print("Setting attribute: ", key)
-            #         print("   type: ", type(value))
-            #         print("   >>> Value is None")
+    def add_set_items(self, setId, items):
+        """ Add several items, the columns are resized and written
+        only once for all of them. Items with an existing id are rejected,
+        unless they have the same values (e.g. sent again after the response
+        of a previous request was lost), then they are skipped.
+        """
+        columns = self._getColumns(setId, create=True)
+        existing = set(columns['id'][:].tolist())
+        seen = set()
+        newItems = []
+        for item in items:
+            itemId = item['id']
+            if itemId in seen or (itemId in existing
+                                  and not self._isSameItem(setId, item)):
+                raise Exception("Item %s already exists in set %s"
+                                % (itemId, setId))
+            seen.add(itemId)
+            if itemId not in existing:
+                newItems.append(item)
+
+        items = newItems
+        if not items:
+            return
+
+        ids = [item['id'] for item in items]
+        first = len(columns['id'])
+        size = first + len(items)
+        self._resizeColumns(columns, size)
+        columns['id'][first:size] = ids
+        columnValues = {}
+
+        for i, item in enumerate(items):
+            itemValues = {}
+            for key, value in item.items():
+                if key == 'id':
+                    continue
+                if self._isColumnValue(key, value):
+                    columnValues.setdefault(key, {})[i] = value
+                elif value is not None:
+                    itemValues[key] = value
+
+            if itemValues:
+                itemId = item['id']
+                micGroup = self._file.create_group(self._getItemPath(setId,
+                                                                     itemId))
+                micGroup.attrs['id'] = itemId
+                for key, value in itemValues.items():
+                    self._setItemValue(micGroup, key, value)
+
+        for key, values in columnValues.items():
+            column = self._fitColumn(columns, key, values.values(), size)
+            data = column[first:size]
+            for i, value in values.items():
+                data[i] = value
+            column[first:size] = data
+            if self._columnKind(column) != 'str':
+                self._updateStats(setId, key, list(values.values()))
 
     def update_set_item(self, setId, itemId, attrDict):
-        micAttrs = self._file[self._getMicPath(setId, itemId)].attrs
-        micAttrs.update(**attrDict)
+        columns = self._getColumns(setId)
+        row = None if columns is None else self._getRow(columns, itemId)
+        itemValues = {}
+
+        for key, value in attrDict.items():
+            if row is not None and self._isColumnValue(key, value):
+                column = self._fitColumn(columns, key, [value],
+                                         len(columns['id']))
+                kind = self._columnKind(column)
+                oldValue = column[row]
+                column[row] = value
+                if kind != 'str':
+                    if not self._isMissing(kind, oldValue):  # Replaced value
+                        self._resetStats(setId, key)
+                    else:
+                        self._updateStats(setId, key, value)
+            else:
+                itemValues[key] = value
+
+        if itemValues:
+            itemPath = self._getItemPath(setId, itemId)
+            if itemPath not in self._file:
+                self._file.create_group(itemPath).attrs['id'] = itemId
+            itemGroup = self._file[itemPath]
+            for key, value in itemValues.items():
+                if key in itemGroup:
+                    del itemGroup[key]
+                self._setItemValue(itemGroup, key, value)
+
+    def get_set_stats(self, setId, attrList):
+        """ Return the stored stats of the set numeric columns. For files
+        without stats, these are computed and stored if the file is writable,
+        or kept while the file is open otherwise (open files are reused
+        while not modified, see SessionDataCache).
+        """
+        stats = {}
+        for a in attrList:
+            stats[a] = self._loadStats(setId, a)
+            if stats[a] is None:
+                stats[a] = self._computedStats.get((setId, a), None)
+            if stats[a] is None:
+                stats[a] = SetStats()
+                columns = self._getColumns(setId)
+                if columns is None:
+                    stats[a] = super().get_set_stats(setId, [a])[a]
+                elif a in columns:
+                    stats[a].add(self._numericColumn(columns[a]))
+                if self._mode != 'r' and columns is not None:
+                    self._saveStats(setId, a, stats[a])
+                else:
+                    self._computedStats[(setId, a)] = stats[a]
+        return stats
 
     def close(self):
-        self._file.close()
+        """ Close the file, or release it if it was opened from a cache. """
+        if self._cache is not None:
+            self._cache.release(self)
+        else:
+            self._file.close()
+
+    def _openFile(self, path, mode, locking=True):
+        """ Open the file, retrying while it is locked by another process
+        (HDF5 locks files while they are open).
+        """
+        start = time.time()
+        while True:
+            try:
+                return h5py.File(path, mode, locking=locking)
+            except OSError as e:
+                if ('lock' not in str(e)
+                        or time.time() - start > self.LOCK_TIMEOUT):
+                    raise
+                time.sleep(0.1)
 
     def _getItemPath(self, setId, itemId):
         return '%s/item%06d' % (self._getSetPath(setId), itemId)
 
+    def _isSameItem(self, setId, item):
+        """ Check if the stored item has the given values. """
+        keys = [k for k in item if k != 'id']
+        stored = self.get_set_item(setId, item['id'], keys)
+        for k in keys:
+            value = item[k]
+            if k in ImageSessionData.MIC_DATA_ATTRS:
+                value = b'' if value is None else image.data_to_bytes(value)
+            if isinstance(value, np.ndarray):
+                if not np.array_equal(stored[k], value):
+                    return False
+            elif stored[k] != value:
+                return False
+        return True
+
+    def _getItemGroup(self, setId, itemId):
+        """ Return the group of the item or None if it has none. """
+        itemPath = self._getItemPath(setId, itemId)
+        return self._file[itemPath] if itemPath in self._file else None
+
+    def _getColumns(self, setId, create=False):
+        """ Return the group with the columns of the set or None if the
+        set uses the old layout. When the columns are created, the values
+        of existing items in the old layout are moved to them.
+        """
+        path = '%s/%s' % (self._getSetPath(setId), self.COLUMNS)
+        if path in self._file:
+            return self._file[path]
+
+        if not create:
+            return None
+
+        columns = self._file.create_group(path)
+        columns.create_dataset('id', shape=(0,), maxshape=(None,),
+                               dtype=np.int64, chunks=(self.CHUNK_SIZE,))
+        self._migrateItems(setId, columns)
+        return columns
+
+    def _migrateItems(self, setId, columns):
+        """ Move the scalar values of the items stored as attributes of
+        their groups (old layout) to the columns of the set.
+        """
+        setGroup = self._file[self._getSetPath(setId)]
+        groups = [g for k, g in sorted(setGroup.items())
+                  if k.startswith('item') and 'id' in g.attrs]
+        if not groups:
+            return
+
+        size = len(groups)
+        self._resizeColumns(columns, size)
+        columns['id'][:] = [int(g.attrs['id']) for g in groups]
+        columnValues = {}
+
+        for i, group in enumerate(groups):
+            for key, value in list(group.attrs.items()):
+                if key != 'id' and self._isColumnValue(key, value):
+                    columnValues.setdefault(key, {})[i] = value
+                    del group.attrs[key]
+
+        for key, values in columnValues.items():
+            column = self._fitColumn(columns, key, values.values(), size)
+            data = column[:]
+            for i, value in values.items():
+                data[i] = value
+            column[:] = data
+
+    def _getStatsPath(self, setId, key):
+        return '%s/%s/%s' % (self._getSetPath(setId), self.STATS, key)
+
+    def _loadStats(self, setId, key):
+        path = self._getStatsPath(setId, key)
+        if path not in self._file:
+            return None
+        return SetStats(**self._file[path].attrs)
+
+    def _saveStats(self, setId, key, stats):
+        path = self._getStatsPath(setId, key)
+        group = self._file.require_group(path)
+        group.attrs.update(stats.toDict())
+
+    def _updateStats(self, setId, key, value):
+        stats = self._loadStats(setId, key)
+        if stats is None:  # New column or file without stats
+            stats = SetStats()
+            values = self._numericColumn(self._getColumns(setId)[key])
+        else:
+            values = value
+        stats.add(values)
+        self._saveStats(setId, key, stats)
+
+    def _resetStats(self, setId, key):
+        """ Compute the stats again after a value has been replaced. """
+        stats = SetStats()
+        stats.add(self._numericColumn(self._getColumns(setId)[key]))
+        self._saveStats(setId, key, stats)
+
+    def _setItemValue(self, group, key, value):
+        """ Store images as compressed binary datasets, arrays as
+        datasets and other values as attributes of the item group.
+        """
+        if key in ImageSessionData.MIC_DATA_ATTRS:
+            value = image.data_to_bytes(value)
+            data = np.frombuffer(value, dtype=np.uint8)
+            dataset = group.create_dataset(
+                key, data=data, compression='gzip' if len(data) else None)
+            # Stored to get the hash without reading the image
+            dataset.attrs['md5'] = hashlib.md5(value).hexdigest()
+        elif isinstance(value, np.ndarray):
+            group.create_dataset(key, data=value)
+        else:
+            group.attrs[key] = value
+
+    def _itemValue(self, group, key):
+        """ Read a value from the item group. Images are returned as bytes
+        (also if stored as base64 strings as in older files).
+        """
+        if key in ImageSessionData.MIC_DATA_ATTRS:
+            if group is not None and key in group:
+                return group[key][()].tobytes()
+            value = group.attrs.get(key, '') if group is not None else ''
+            return image.base64_to_bytes(value)
+
+        if group is None:
+            return None
+
+        if key in group:
+            return group[key][()]
+
+        return group.attrs.get(key, None)
+
+    def _isColumnValue(self, key, value):
+        if key in ImageSessionData.MIC_DATA_ATTRS:
+            return False
+        return isinstance(value, (int, float, str, np.number, np.bool_))
+
+    @staticmethod
+    def _valueKind(value):
+        if isinstance(value, (str, bytes)):
+            return 'str'
+        if isinstance(value, (bool, np.bool_)):
+            return 'bool'
+        if isinstance(value, (int, np.integer)):
+            return 'int'
+        return 'float'
+
+    def _columnKind(self, column):
+        """ Return the kind of values in the column: str, bool, int or
+        float (columns without kind are from older files).
+        """
+        if h5py.check_string_dtype(column.dtype):
+            return 'str'
+        default = 'int' if column.dtype.kind in 'iu' else 'float'
+        return column.attrs.get('kind', default)
+
+    def _isMissing(self, kind, value):
+        if kind == 'str':
+            return False
+        if kind == 'float':
+            return value != value  # NaN
+        return value == self.COLUMN_TYPES[kind][1]
+
+    def _createColumn(self, columns, key, kind, size):
+        if kind == 'str':
+            dtype, fill = h5py.string_dtype(), ''
+        else:
+            dtype, fill = self.COLUMN_TYPES[kind]
+        column = columns.create_dataset(key, shape=(size,), maxshape=(None,),
+                                        dtype=dtype, fillvalue=fill,
+                                        chunks=(self.CHUNK_SIZE,))
+        column.attrs['kind'] = kind
+        return column
+
+    def _fitColumn(self, columns, key, values, size):
+        """ Return the column for the given values. The column is created
+        for the kind of the values if it does not exist, and numeric
+        columns are widened (bool -> int -> float) if the values need it.
+        """
+        kinds = {self._valueKind(v) for v in values}
+        if key not in columns:
+            kind = ('str' if 'str' in kinds
+                    else max(kinds, key=self.NUMERIC_KINDS.index))
+            return self._createColumn(columns, key, kind, size)
+
+        column = columns[key]
+        kind = self._columnKind(column)
+        if kind == 'str' or 'str' in kinds:
+            return column
+
+        newKind = max(kinds | {kind}, key=self.NUMERIC_KINDS.index)
+        if newKind == kind:
+            return column
+
+        data = column[:]
+        missing = data == self.COLUMN_TYPES[kind][1]
+        del columns[key]
+        column = self._createColumn(columns, key, newKind, len(data))
+        dtype, fill = self.COLUMN_TYPES[newKind]
+        data = data.astype(dtype)
+        data[missing] = fill
+        column[:] = data
+        return column
+
+    def _numericColumn(self, column):
+        """ Read the values of a numeric column, missing values are NaN
+        (integers are only converted to float if there are missing ones).
+        """
+        kind = self._columnKind(column)
+        data = column[:]
+        if kind == 'float':
+            return data
+        missing = data == self.COLUMN_TYPES[kind][1]
+        if kind == 'bool' or missing.any():
+            data = data.astype(np.float64)
+            data[missing] = np.nan
+        return data
+
+    def _resizeColumns(self, columns, size):
+        for column in columns.values():
+            column.resize((size,))
+
+    @staticmethod
+    def _readRows(column, rows):
+        """ Read only the given rows of the column dataset, in the same
+        order. Contiguous rows are read as a slice.
+        """
+        if len(rows) == 0:
+            return column[0:0]
+        sortedRows = np.unique(rows)
+        first, last = sortedRows[0], sortedRows[-1]
+        if last - first + 1 == len(sortedRows):
+            values = column[first:last + 1]
+        else:
+            values = column[sortedRows]
+        return values[np.searchsorted(sortedRows, rows)]
+
+    def _getColumn(self, columns, name):
+        """ Read a whole column to evaluate conditions over it. """
+        self._checkConditionAttr(name)
+        if name not in columns:
+            return np.full(len(columns['id']), np.nan)
+        column = columns[name]
+        if self._columnKind(column) == 'str':
+            return column.asstr()[:]
+        return self._numericColumn(column)
+
+    @staticmethod
+    def _checkConditionAttr(name):
+        if name not in ImageSessionData.MIC_ATTRS:
+            raise Exception("Invalid attribute in condition: %s" % name)
+
+    def _getRow(self, columns, itemId):
+        rows = np.nonzero(columns['id'][:] == itemId)[0]
+        return int(rows[0]) if len(rows) else None
+
+    def _columnValue(self, value, kind):
+        """ Convert values read from columns to Python types, with None
+        for missing values.
+        """
+        if isinstance(value, bytes):
+            return value.decode()
+        value = value.item()
+        if self._isMissing(kind, value):
+            return None
+        return bool(value) if kind == 'bool' else value
+
     def _getSetPath(self, setId):
         return '/Sets/%s' % setId
 
@@ -184,6 +949,167 @@ class H5SessionData(SessionData):
                 % (setId, '' if itemId is None else '/item%05d' % itemId))
 
 
+class SessionDataCache:
+    """ Share open H5SessionData files between the requests of a process.
+
+    HDF5 locks files while they are open, so a file kept open here would
+    block other processes (e.g. other server workers) that need to write
+    it. Hence, files opened for writing are closed as soon as they are
+    released, and files are opened for reading without locking them.
+    A file opened for reading is reused during maxAge seconds after being
+    opened while it is not modified (its modification time and size do not
+    change), otherwise it is opened again to read the changes. Unused files
+    are closed when they expire. Opening a file locked by another process
+    is retried for some time (see H5SessionData.LOCK_TIMEOUT).
+
+    Files are opened with acquire() and should be closed (i.e released)
+    by the caller as usual.
+    """
+    def __init__(self, maxSize=8, maxAge=60):
+        """
+        Args:
+            maxSize: maximum number of files that are kept open.
+            maxAge: seconds after opening that a file can be reused
+                for reading.
+        """
+        self._maxSize = maxSize
+        self._maxAge = maxAge
+        self._entries = OrderedDict()  # path -> entry dict
+        self._cond = threading.Condition()
+        self._timer = None
+
+    def acquire(self, path, mode='r'):
+        """ Return an open H5SessionData for the given path.
+        A file opened in 'a' mode is shared while it is in use, also for
+        'r' requests. A file opened in 'r' mode is closed before opening
+        it for writing, waiting until it is released by other users.
+        """
+        with self._cond:
+            while True:
+                entry = self._entries.get(path, None)
+                if entry is None or self.__is_valid(entry, mode):
+                    break
+                if entry['refs'] == 0:
+                    self.__close(path)
+                else:
+                    self._cond.wait()
+
+            if entry is not None:
+                entry['refs'] += 1
+                self._entries.move_to_end(path)
+                while entry['data'] is None:  # Being opened by other thread
+                    self._cond.wait()
+                    if path not in self._entries:  # Opening failed
+                        return self.acquire(path, mode)
+                return entry['data']
+
+            # Open the file without blocking other users of the cache,
+            # it might take some time if locked by another process
+            entry = {'data': None, 'mode': mode, 'refs': 1,
+                     'opened': time.time()}
+            self._entries[path] = entry
+
+        try:
+            data = H5SessionData(path, mode, locking=(mode != 'r'))
+        except Exception:
+            with self._cond:
+                self._entries.pop(path, None)
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            if self._entries.get(path) is not entry:  # Closed meanwhile
+                self._cond.notify_all()
+                return data
+            data._cache = self
+            entry.update(data=data, mtime=self.__mtime(path))
+            self.__cleanup()
+            self._cond.notify_all()
+            return data
+
+    def release(self, data):
+        """ Release the file after being used. """
+        with self._cond:
+            entry = self._entries[data._path]
+            entry['refs'] -= 1
+            if entry['refs'] == 0:
+                if data._mode != 'r' or self.__expired(entry):
+                    self.__close(data._path)
+                else:
+                    self.__schedule_cleanup()
+            self._cond.notify_all()
+
+    def discard(self, path):
+        """ Close the file (e.g. before deleting it). """
+        with self._cond:
+            while path in self._entries and self._entries[path]['refs']:
+                self._cond.wait()
+            if path in self._entries:
+                self.__close(path)
+
+    def close_all(self):
+        with self._cond:
+            for path in list(self._entries):
+                self.__close(path)
+
+    def __is_valid(self, entry, mode):
+        if entry['mode'] != 'r':
+            return True  # Write files are only kept while in use
+        if mode != 'r':
+            return False
+        if entry['refs']:
+            return True
+        # Check if the file was modified by another process
+        return (not self.__expired(entry)
+                and entry['mtime'] == self.__mtime(entry['data']._path))
+
+    def __expired(self, entry):
+        return time.time() - entry['opened'] >= self._maxAge
+
+    def __mtime(self, path):
+        """ Return the modification time and size of the file. """
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def __close(self, path):
+        entry = self._entries.pop(path)
+        if entry['data'] is not None:
+            entry['data']._file.close()
+
+    def __cleanup(self):
+        """ Close expired files and least recently used ones if needed. """
+        unused = [p for p, e in self._entries.items()
+                  if e['refs'] == 0 and e['data'] is not None]
+        extra = len(self._entries) - self._maxSize
+
+        for path in unused:  # From least to most recently used
+            if extra > 0 or self.__expired(self._entries[path]):
+                self.__close(path)
+                extra -= 1
+
+    def __schedule_cleanup(self):
+        """ Close unused files when they expire, even if the cache is not
+        used again, so they do not stay locked.
+        """
+        if self._timer is None:
+            self._timer = threading.Timer(self._maxAge, self.__timer_cleanup)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def __timer_cleanup(self):
+        with self._cond:
+            self._timer = None
+            self.__cleanup()
+            if any(e['refs'] == 0 for e in self._entries.values()):
+                self.__schedule_cleanup()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class ImageSessionData(SessionData):
     """
     Very simple implementation of SessionData for testing purposes.
@@ -234,13 +1160,19 @@ class ImageSessionData(SessionData):
     def create_set(self, setId, attrDict):
         raise Exception("Not supported.")
 
-    def get_set_items(self, setId, attrList=None, condition=None):
-        if condition is not None:
-            raise Exception("condition evaluation not implemented. ")
-
+    def get_set_items(self, setId, attrList=None, condition=None,
+                      orderBy=None, limit=None):
         attrs = self._get_attrs(attrList)
 
-        return [self._get_dict_from_row(row, attrs) for row in self._rows]
+        def _getColumn(name):
+            if name not in self.MIC_ATTRS:
+                raise Exception("Invalid attribute in condition: %s" % name)
+            return np.array([row[self.MIC_ATTRS[name]] for row in self._rows])
+
+        rows = select_rows(len(self._rows), _getColumn, condition,
+                           orderBy, limit)
+
+        return [self._get_dict_from_row(self._rows[r], attrs) for r in rows]
 
     def get_set_item(self, setId, itemId, attrList=None):
         return self._get_dict_from_row(self._rowsDict[itemId],
@@ -333,10 +1265,14 @@ class PytablesSessionData(SessionData):
         ctfDefocusAngle = tbl.Float32Col()
         ctfResolution = tbl.Float32Col()
         ctfFit = tbl.Float32Col()
-        micThumbData = tbl.StringCol(256000)
-        psdData = tbl.StringCol(256000)
-        ctfFitData = tbl.StringCol(256000)
-        shiftPlotData = tbl.StringCol(256000)
+
+    # Images are not stored in the Micrograph table but in a compressed
+    # VLArray per set and image attribute, with one row per micrograph.
+    # VLArray rows can not be resized, so updated images are appended and
+    # the '<key>Rows' array maps each micrograph to its current row.
+    # Older files keep the images as base64 strings in the table.
+    DATA_ATTRS = ImageSessionData.MIC_DATA_ATTRS
+    DATA_FILTERS = tbl.Filters(complevel=5, complib='zlib')
 
     def __init__(self, h5File, mode='r'):
         if mode == 'r':
@@ -378,6 +1314,9 @@ class PytablesSessionData(SessionData):
                                              self.Micrograph, "Mics table")
         mics_table.flush()
 
+        for key in self.DATA_ATTRS:
+            self._getDataArray(setId, key, create=True)
+
     def get_items(self, setId, attrList=None, condition=None,
                   itemId=None):
         mics_table = self._file.get_node(self._getMicSet(setId), 'mics_tbl')
@@ -392,15 +1331,19 @@ class PytablesSessionData(SessionData):
         Micrograph = namedtuple('Micrograph', keys)
         micList = []
 
-        for row in mics_table:
+        def _getColumn(name):
+            if name not in mics_table.colnames:
+                raise Exception("Invalid attribute in condition: %s" % name)
+            return mics_table.col(name)
+
+        rows = select_rows(mics_table.nrows, _getColumn, condition)
+
+        for i in rows:
+            row = mics_table[i]
             values = dict()
             for k in keys:
-                if isinstance(row[k], bytes):
-                    values[k] = row[k].decode()
-                else:
-                    values[k] = row[k]
+                values[k] = self._getValue(setId, mics_table, row, i, k)
 
-            #values = {k: row[k] for k in keys}
             micList.append(Micrograph(**values))
 
         return micList
@@ -408,18 +1351,15 @@ class PytablesSessionData(SessionData):
     def get_item(self, setId, itemId, dataAttrs=None):
         print("Requesting item: setId: %s, itemId: %s" % (setId, itemId))
         mics_table = self._file.get_node(self._getMicSet(setId), 'mics_tbl')
-        mic = mics_table[itemId-1]  # pytables rows start from 0
+        rowIndex = itemId - 1  # pytables rows start from 0
+        mic = mics_table[rowIndex]
 
         keys = mics_table.colnames if dataAttrs is None else dataAttrs
         Micrograph = namedtuple('Micrograph',keys)
         values = dict()
         for k in keys:
-            if isinstance(mic[k], bytes):
-                values[k] = mic[k].decode()
-            else:
-                values[k] = mic[k]
+            values[k] = self._getValue(setId, mics_table, mic, rowIndex, k)
 
-        #values = {k: mic[k] for k in keys}
         return Micrograph(**values)
 
     def add_item(self, setId, itemId, **attrDict):
@@ -427,6 +1367,24 @@ class PytablesSessionData(SessionData):
         mic = mics_table.row
 
         attrDict.update({'id': itemId})
+        data = {}
+        for key in self.DATA_ATTRS:
+            value = image.data_to_bytes(attrDict.pop(key, b''))
+            if key in mics_table.colnames:
+                attrDict[key] = image.bytes_to_base64(value)
+            else:
+                data[key] = value
+
+        # Add a row for each image (even if empty) to keep rows aligned
+        for key, value in data.items():
+            dataArray = self._getDataArray(setId, key, create=True)
+            rowsArray = self._getRowsArray(setId, key)
+            if rowsArray is not None:
+                rowsArray.append([dataArray.nrows])
+                rowsArray.flush()
+            dataArray.append(np.frombuffer(value, dtype=np.uint8))
+            dataArray.flush()
+
         for key, value in attrDict.items():
             mic[key] = value
 
@@ -435,11 +1393,89 @@ class PytablesSessionData(SessionData):
 
     def update_item(self, setId, itemId, **attrDict):
         mics_table = self._file.get_node(self._getMicSet(setId), 'mics_tbl')
-        itemId = int(itemId) - 1  # pytables rows start from 0
-        mics_table.modify_columns(itemId, itemId+1,
-                                  columns=[[x] for x in attrDict.values()],
-                                  names=list(attrDict.keys()))
-        mics_table.flush()
+        rowIndex = int(itemId) - 1  # pytables rows start from 0
+
+        for key in self.DATA_ATTRS:
+            if key not in attrDict:
+                continue
+            value = image.data_to_bytes(attrDict.pop(key))
+            if key in mics_table.colnames:
+                attrDict[key] = image.bytes_to_base64(value)
+            else:
+                self._updateData(setId, key, rowIndex, value)
+
+        if attrDict:
+            mics_table.modify_columns(rowIndex, rowIndex+1,
+                                      columns=[[x] for x in attrDict.values()],
+                                      names=list(attrDict.keys()))
+            mics_table.flush()
+
+    def _updateData(self, setId, key, rowIndex, value):
+        """ Replace the image of the given row. Values of the same length
+        are written in place, otherwise the new value is appended and
+        the row is pointed to it.
+        """
+        data = np.frombuffer(value, dtype=np.uint8)
+        dataArray = self._getDataArray(setId, key, create=True)
+        rowsArray = self._getRowsArray(setId, key)
+        dataRow = rowIndex if rowsArray is None else int(rowsArray[rowIndex])
+
+        if len(dataArray[dataRow]) == len(data):
+            dataArray[dataRow] = data
+        else:
+            if rowsArray is None:
+                rowsArray = self._file.create_earray(
+                    self._getMicSet(setId), key + 'Rows', tbl.Int64Atom(),
+                    shape=(0,), obj=np.arange(dataArray.nrows))
+            rowsArray[rowIndex] = dataArray.nrows
+            dataArray.append(data)
+            rowsArray.flush()
+        dataArray.flush()
+
+    def _getDataArray(self, setId, key, create=False):
+        """ Return the VLArray with the images of the given attribute.
+        If it does not exist (e.g. in older files) and create is True,
+        it is created with empty rows for the existing micrographs.
+        """
+        micSet = self._getMicSet(setId)
+        path = '%s/%s' % (micSet, key)
+        if path in self._file:
+            return self._file.get_node(path)
+
+        if not create:
+            return None
+
+        dataArray = self._file.create_vlarray(micSet, key, tbl.UInt8Atom(),
+                                              filters=self.DATA_FILTERS)
+        empty = np.zeros(0, dtype=np.uint8)
+        for _ in range(self._file.get_node(micSet, 'mics_tbl').nrows):
+            dataArray.append(empty)
+        return dataArray
+
+    def _getRowsArray(self, setId, key):
+        path = '%s/%sRows' % (self._getMicSet(setId), key)
+        return self._file.get_node(path) if path in self._file else None
+
+    def _getValue(self, setId, mics_table, row, rowIndex, key):
+        """ Return the value from the table row or from the images
+        arrays. Images are returned as bytes.
+        """
+        if key in mics_table.colnames:
+            value = row[key]
+            if isinstance(value, bytes):
+                value = value.decode()
+                # Older files stored images as base64 strings in the table
+                if key in self.DATA_ATTRS:
+                    value = image.base64_to_bytes(value)
+            return value
+
+        dataArray = self._getDataArray(setId, key)
+        if dataArray is None:
+            return b''
+        rowsArray = self._getRowsArray(setId, key)
+        if rowsArray is not None:
+            rowIndex = int(rowsArray[rowIndex])
+        return dataArray[rowIndex].tobytes()
 
     def close(self):
         self._file.close()
@@ -27,12 +27,16 @@
 # **************************************************************************
 
 import json
+import hashlib
 import unittest
 import random
 import datetime as dt
 
+import requests
+
 from emhub.client import DataClient
 from emhub.utils import (get_quarter, pretty_quarter)
+from emhub.utils.image import bytes_to_base64
 
 
 class TestClientApi(unittest.TestCase):
@@ -85,6 +89,108 @@ class TestClientApi(unittest.TestCase):
 
         sc.logout()
 
+    def test_bookings_range_etag(self):
+        """ Request the same calendar window twice, the second time
+        using the ETag, and check that nothing is sent back. """
+        sc = DataClient()
+        sc.login('mull', 'mull')
+        url = '%s/api/get_bookings_range' % sc._server_url
+        params = {'start': '2020-06-01T00:00:00+02:00',
+                  'end': '2020-06-08T00:00:00+02:00'}
+        r = requests.get(url, params=params, cookies=sc.cookies)
+        r.raise_for_status()
+        etag = r.headers['ETag']
+        self.assertIsInstance(r.json(), list)
+
+        r = requests.get(url, params=params, cookies=sc.cookies,
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+        sc.logout()
+
+    def test_session_image_etag(self):
+        """ Add an item with an image to a session set, then request
+        the image and check that the ETag is used by the server. """
+        sc = DataClient()
+        sc.login('mull', 'mull')
+        sc.request('get_sessions', jsonData={'attrs': ['id']})
+        sessionId = sc.r.json()[0]['id']
+        setId = random.randint(1000, 100000)
+        data = b'\x89PNG\r\n\x1a\n' + bytes(range(256))
+        sc.create_session_set({'session_id': sessionId, 'set_id': setId})
+        sc.add_session_item({'session_id': sessionId, 'set_id': setId,
+                             'item_id': 1,
+                             'micThumbData': bytes_to_base64(data)})
+
+        url = ('%s/images/session/%d/set/%d/item/1/micThumb'
+               % (sc._server_url, sessionId, setId))
+        r = requests.get(url, cookies=sc.cookies)
+        r.raise_for_status()
+        self.assertEqual(r.content, data)
+        self.assertEqual(r.headers['Content-Type'], 'image/png')
+        self.assertIn('no-cache', r.headers['Cache-Control'])
+
+        # Versioned URLs (with the hash of the image) can be cached
+        version = hashlib.md5(data).hexdigest()
+        r = requests.get(url, params={'v': version}, cookies=sc.cookies)
+        self.assertIn('max-age', r.headers['Cache-Control'])
+
+        etag = r.headers['ETag']
+        r = requests.get(url, cookies=sc.cookies,
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+        # Updated images are sent again, with a different ETag
+        jpeg = b'\xff\xd8\xff\xe0' + bytes(range(256))
+        sc.update_session_item({'session_id': sessionId, 'set_id': setId,
+                                'item_id': 1,
+                                'micThumbData': bytes_to_base64(jpeg)})
+        r = requests.get(url, cookies=sc.cookies,
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, jpeg)
+        self.assertEqual(r.headers['Content-Type'], 'image/jpeg')
+
+        r = requests.get(url.replace('micThumb', 'psd'), cookies=sc.cookies)
+        self.assertEqual(r.status_code, 404)
+        r = requests.get(url.replace('/item/1/', '/item/2/'),
+                         cookies=sc.cookies)
+        self.assertEqual(r.status_code, 404)
+        r = requests.get(url.replace('/session/%d/' % sessionId,
+                                     '/session/999999/'), cookies=sc.cookies)
+        self.assertEqual(r.status_code, 404)
+
+        sc.logout()
+
+    def test_add_session_items(self):
+        """ Add and update items of a session set in batches. """
+        sc = DataClient()
+        sc.login('mull', 'mull')
+        sc.request('get_sessions', jsonData={'attrs': ['id']})
+        sessionId = sc.r.json()[0]['id']
+        setId = random.randint(1000, 100000)
+        attrs = {'session_id': sessionId, 'set_id': setId}
+        sc.create_session_set(attrs)
+        items = [{'item_id': i, 'location': 'mic%03d' % i,
+                  'ctfDefocus': 1000.0 * i} for i in range(1, 11)]
+        sc.add_session_items(dict(attrs, items=items))
+        sc.update_session_items(dict(attrs, items=[{'item_id': 2,
+                                                    'ctfDefocus': 5.0}]))
+
+        result = sc.get_session_items(dict(attrs, attrList=['ctfDefocus'],
+                                           condition='ctfDefocus < 2000'))
+        self.assertEqual([i['id'] for i in result], [1, 2])
+
+        # An item sent again (e.g. its response was lost) is not an error,
+        # but different values for an existing id are rejected
+        sc.add_session_item(dict(attrs, **items[4]))
+        with self.assertRaises(Exception):
+            sc.add_session_item(dict(attrs, item_id=5, location='other'))
+        result = sc.get_session_items(dict(attrs, attrList=['location']))
+        self.assertEqual(len(result), 10)
+
+        sc.logout()
+
     def test_create_invoice_periods(self):
         q1 = get_quarter()
         q0 = get_quarter(q1[0] - dt.timedelta(days=1))
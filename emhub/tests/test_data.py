@@ -26,14 +26,28 @@
 # *
 # **************************************************************************
 
+import os
+import shutil
+import hashlib
+import time
+import threading
 import unittest
 import datetime as dt
 from pprint import pprint
+from types import SimpleNamespace
+
+import numpy as np
+import sqlalchemy
+import tables as tbl
 
 from emhub.data import (DataManager, ImageSessionData, H5SessionData,
-                        PytablesSessionData, DataLog)
+                        PytablesSessionData, DataLog, DataContent)
+from emhub.data.data_session import SessionDataCache, SetStats
 from emhub.data.imports.test import TestData
 from emhub.utils import datetime_to_isoformat
+from emhub.utils import image
+from emhub.utils.image import bytes_to_base64
+from emhub.utils.events import EventBus, sse_message
 
 
 class TestDataManager(unittest.TestCase):
@@ -141,6 +155,296 @@ class TestDataManager(unittest.TestCase):
         self.assertFalse(all(m.requires_slot for m in microscopes))
 
 
+class BookingsTestData(TestData):
+    """ Same as TestData but without Sessions (that require EMHUB_TESTDATA).
+    """
+    def _populateSessions(self, dm):
+        pass
+
+
+class TestBookings(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dm = DataManager('/tmp/', dbName='emhub-bookings.sqlite',
+                             cleanDb=True)
+        cls.td = BookingsTestData(cls.dm)
+
+    def test_bookings_range(self):
+        print("=" * 80, "\nTesting bookings range...")
+        dm = self.dm
+        r = dm.get_resource_by(name='Vitrobot 1')
+        start = self.td.firstMonday.replace(hour=9) + dt.timedelta(days=35)
+        end = start + dt.timedelta(hours=8)
+        b = dm.create_booking(title='Range', start=start, end=end,
+                              type='booking', resource_id=r.id,
+                              creator_id=2, owner_id=2)[0]
+
+        def _range(s, e, resource=r):
+            return [x.id for x in dm.get_bookings_range(s, e,
+                                                        resource=resource)]
+
+        h = dt.timedelta(hours=1)
+        # Overlapping windows (including touching the limits)
+        self.assertEqual(_range(start - h, start + h), [b.id])
+        self.assertEqual(_range(end - h, end + h), [b.id])
+        self.assertEqual(_range(start + h, end - h), [b.id])
+        self.assertEqual(_range(start - h, start), [b.id])
+        self.assertEqual(_range(end, end + h), [b.id])
+        # Non-overlapping windows, even within the same day
+        self.assertEqual(_range(start - 2 * h, start - h), [])
+        self.assertEqual(_range(end + h, end + 2 * h), [])
+        # Different timezone should lead to the same results
+        tz = dt.timezone(dt.timedelta(hours=2))
+        self.assertEqual(_range((start + h).astimezone(tz),
+                                (start + 2 * h).astimezone(tz)), [b.id])
+        # Without resource, other bookings might be returned
+        self.assertIn(b.id, _range(start, end, resource=None))
+        # Filtering by a list of resources
+        r2 = dm.get_resource_by(name='Vitrobot 2')
+        bookings = dm.get_bookings_range(start, end, resource_ids=[r2.id])
+        self.assertNotIn(b.id, [x.id for x in bookings])
+        bookings = dm.get_bookings_range(start, end,
+                                         resource_ids=[r.id, r2.id])
+        self.assertIn(b.id, [x.id for x in bookings])
+
+    def test_repeating_bookings(self):
+        print("=" * 80, "\nTesting repeating bookings overlap...")
+        dm = self.dm
+        r = dm.get_resource_by(name='Vitrobot 2')
+        start = self.td.firstMonday.replace(hour=9) + dt.timedelta(days=35)
+        repeat_stop = start + dt.timedelta(days=30)
+
+        def _create(**kwargs):
+            attrs = dict(title='Weekly', type='booking', resource_id=r.id,
+                         creator_id=2, owner_id=2, repeat_value='weekly')
+            attrs.update(kwargs)
+            if attrs['repeat_value'] != 'no':
+                attrs['repeat_stop'] = repeat_stop
+            return dm.create_booking(**attrs)
+
+        bookings = _create(start=start, end=start + dt.timedelta(hours=8))
+        self.assertEqual(len(bookings), 5)
+
+        # Overlapping with the third booking of the series
+        third = bookings[2]
+        with self.assertRaisesRegex(Exception, 'overlapping'):
+            _create(start=third.start + dt.timedelta(hours=2),
+                    end=third.end + dt.timedelta(hours=2),
+                    repeat_value='no')
+
+        # Bookings of the same series overlapping between them
+        other = start + dt.timedelta(days=1)
+        with self.assertRaisesRegex(Exception, 'overlapping'):
+            _create(start=other, end=other + dt.timedelta(days=8))
+
+    def test_bookings_profile(self):
+        print("=" * 80, "\nTesting bookings loading profile...")
+        dm = self.dm
+        engine = dm._db_session.get_bind()
+        user = [u for u in dm.get_users() if u.is_manager][0]
+        dc = DataContent(SimpleNamespace(dm=dm, user=user))
+        queries = []
+
+        def _count(*args):
+            queries.append(args[2])
+
+        def _events(start, end):
+            dm._db_session.expunge_all()
+            dm._db_session.add(user)
+            del queries[:]
+            sqlalchemy.event.listen(engine, 'before_cursor_execute', _count)
+            try:
+                events = [dc.booking_to_event(b)
+                          for b in dm.get_bookings_range(start, end,
+                                                         profile='event')]
+            finally:
+                sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                        _count)
+            return len(events), len(queries)
+
+        first = self.td.firstMonday
+        n1, q1 = _events(first, first + dt.timedelta(days=7))
+        n2, q2 = _events(first - dt.timedelta(days=365),
+                         first + dt.timedelta(days=365))
+        self.assertGreater(n2, n1)
+        self.assertEqual(q1, q2)
+
+        with self.assertRaisesRegex(Exception, 'Unknown'):
+            dm.get_bookings(profile='nonexistent')
+
+    def test_filters(self):
+        print("=" * 80, "\nTesting structured filters...")
+        from emhub.data.data_filter import filter_shape, _compile_shape
+        dm = self.dm
+
+        def _ids(condition):
+            return sorted(b.id for b in dm.get_bookings(condition=condition))
+
+        # Structured filters should give the same results as legacy ones
+        typeCond = {'or': [{'field': 'type', 'op': '==', 'value': 'booking'},
+                           {'field': 'type', 'op': '==', 'value': 'downtime'}]}
+        self.assertEqual(_ids(typeCond),
+                         _ids("type='booking' OR type='downtime'"))
+        self.assertEqual(
+            _ids({'field': 'type', 'op': 'in',
+                  'value': ['booking', 'downtime']}),
+            _ids(typeCond))
+
+        fm = self.td.firstMonday + dt.timedelta(days=14)
+        dateStr = datetime_to_isoformat(fm)
+        startCond = [{'field': 'start', 'op': '<=', 'value': dateStr},
+                     {'type': 'booking'}]
+        self.assertEqual(_ids(startCond),
+                         _ids("start<='%s' AND type='booking'" % dateStr))
+
+        b = dm.get_bookings()[0]
+        self.assertEqual(_ids({'id': b.id}), [b.id])
+        self.assertEqual(_ids({'not': {'id': b.id}}),
+                         [x for x in _ids(None) if x != b.id])
+
+        # Same shape with different values should reuse the expression
+        info = _compile_shape.cache_info()
+        _ids({'id': b.id + 1})
+        self.assertEqual(_compile_shape.cache_info().hits, info.hits + 1)
+        self.assertEqual(filter_shape({'id': 1}), filter_shape({'id': 2}))
+
+        with self.assertRaisesRegex(Exception, 'unknown field'):
+            _ids({'field': 'id; DROP TABLE bookings', 'value': 1})
+        with self.assertRaisesRegex(Exception, 'unknown operator'):
+            _ids({'field': 'id', 'op': 'OR 1=1', 'value': 1})
+        with self.assertRaisesRegex(Exception, 'unknown operator'):
+            _ids({'field': 'id', 'op': ['=='], 'value': 1})
+        with self.assertRaisesRegex(Exception, 'unknown field'):
+            _ids({'field': {'name': 'id'}, 'value': 1})
+
+    def test_projection(self):
+        print("=" * 80, "\nTesting attrs projection...")
+        dm = self.dm
+        full = dm.get_bookings(asJson=True, orderBy='start')
+        items = dm.get_bookings(asJson=True, orderBy='start',
+                                attrs=['id', 'title', 'start'])
+        self.assertEqual(len(items), len(full))
+        for item, b in zip(items, full):
+            self.assertEqual(item, {k: b[k] for k in ['id', 'title', 'start']})
+
+        # Filters should be applied together with the projection
+        items = dm.get_users(condition={'username': 'mull'}, asJson=True,
+                             attrs=['id', 'name'])
+        self.assertEqual(len(items), 1)
+        self.assertEqual(set(items[0]), {'id', 'name'})
+
+        # Non-column attributes require loading the objects
+        items = dm.get_applications(asJson=True, attrs=['id', 'pi_list'])
+        self.assertIn('pi_list', items[0])
+
+    def test_pagination(self):
+        print("=" * 80, "\nTesting keyset pagination...")
+        dm = self.dm
+
+        def _pages(**kwargs):
+            pages, last = [], {}
+            while True:
+                page = dm.get_bookings(asJson=True, attrs=['id', 'start'],
+                                       limit=3, **kwargs, **last)
+                if not page:
+                    return pages
+                pages.append(page)
+                last = {'after_id': page[-1]['id']}
+                if kwargs:
+                    last['after_start'] = page[-1]['start']
+
+        ids = sorted(b.id for b in dm.get_bookings())
+        pages = _pages()
+        self.assertTrue(all(len(p) <= 3 for p in pages))
+        self.assertEqual([b['id'] for p in pages for b in p], ids)
+
+        pages = _pages(orderBy='start')
+        self.assertEqual(sorted(b['id'] for p in pages for b in p), ids)
+        items = [b for p in pages for b in p]
+        self.assertEqual(items, sorted(items,
+                                       key=lambda b: (b['start'], b['id'])))
+
+        # Iterate over all items in batches
+        items = dm.get_bookings(asJson=True, iterate=True)
+        self.assertNotIsInstance(items, list)
+        self.assertEqual(sorted(b['id'] for b in items), ids)
+
+        with self.assertRaisesRegex(Exception, 'Pagination'):
+            dm.get_bookings(orderBy='title', limit=3)
+
+    def test_engine_settings(self):
+        print("=" * 80, "\nTesting database engine settings...")
+
+        def _pragma(dm, name):
+            return dm._db_session.execute(
+                sqlalchemy.text('PRAGMA %s' % name)).scalar()
+
+        self.assertEqual(_pragma(self.dm, 'journal_mode'), 'wal')
+        self.assertEqual(_pragma(self.dm, 'synchronous'), 1)  # NORMAL
+        self.assertEqual(_pragma(self.dm, 'busy_timeout'), 10000)
+
+        dm = DataManager('/tmp/', dbName='emhub-bookings.sqlite',
+                         pragmas={'busy_timeout': 500, 'mmap_size': None},
+                         engineOptions={'pool_size': 2})
+        self.assertEqual(_pragma(dm, 'busy_timeout'), 500)
+        self.assertEqual(dm._db_session.get_bind().pool.size(), 2)
+        self.assertEqual(len(dm.get_bookings()), len(self.dm.get_bookings()))
+        dm.close()
+
+    def test_db_url(self):
+        print("=" * 80, "\nTesting database from URL...")
+        url = 'sqlite:////tmp/emhub-bookings-url.sqlite'
+        dm = DataManager('/tmp/', dbUrl=url, cleanDb=True)
+        BookingsTestData(dm)
+        n = len(dm.get_bookings())
+        self.assertGreater(n, 0)
+        # Logs are stored in the same database
+        self.assertTrue(dm._db_log.get_logs())
+        engine = dm._db_session.get_bind()
+        self.assertIn('logs', sqlalchemy.inspect(engine).get_table_names())
+        dm.close()
+
+        # Existing tables should be reused
+        dm = DataManager('/tmp/', dbUrl=url)
+        self.assertEqual(len(dm.get_bookings()), n)
+        dm.close()
+
+    def test_usage(self):
+        print("=" * 80, "\nTesting applications usage...")
+        dm = self.dm
+        applications = [a.id for a in dm.get_applications()]
+
+        # Count directly from all bookings
+        expected = {}
+        for b in dm.get_bookings():
+            if b.application_id is not None:
+                key = (b.application_id, b.resource_id)
+                expected[key] = expected.get(key, 0) + b.days
+
+        self.assertTrue(expected)
+        count = dm.count_booking_resources(applications)
+        for (aid, rid), days in expected.items():
+            self.assertEqual(count[aid][rid], days)
+
+        self.assertEqual(dm.rebuild_usage(), [])
+
+        # Deleting a booking should update the usage
+        b = next(b for b in dm.get_bookings() if b.application_id)
+        key = (b.application_id, b.resource_id)
+        dm.delete_booking(id=b.id)
+        count = dm.count_booking_resources([key[0]])
+        self.assertEqual(count[key[0]][key[1]], expected[key] - b.days)
+
+        # Introduce some drift and check that it is reported and fixed
+        usage = dm.ApplicationUsage.query.get(key)
+        usage.days += 3
+        dm.commit()
+        drift = dm.rebuild_usage()
+        self.assertEqual(len(drift), 1)
+        self.assertEqual(drift[0][:2], key)
+        self.assertEqual(dm.rebuild_usage(), [])
+
+
 class TestSessionData(unittest.TestCase):
     def test_basic(self):
         setId = 1
@@ -182,6 +486,531 @@ class TestSessionData(unittest.TestCase):
 
 
 
+class TestH5SessionData(unittest.TestCase):
+    def test_columns(self):
+        print("=" * 80, "\nTesting h5py session columns...")
+        path = '/tmp/emhub-h5-columns.h5'
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+
+        for i in range(1, 11):
+            attrs = {'location': 'mic%03d.mrc' % i,
+                     'ctfDefocus': 10000.0 + i,
+                     'micThumbData': b'thumb-data-%d' % i}
+            if i > 5:  # New attribute after some items
+                attrs['ctfResolution'] = 3.0 + i / 10
+            hsd.add_set_item(1, i, attrs)
+
+        hsd.update_set_item(1, 3, {'ctfDefocus': 5.0, 'psdData': b'psd'})
+        hsd.close()
+
+        hsd = H5SessionData(path, 'r')
+        mics = hsd.get_set_items(1, ['location', 'ctfDefocus',
+                                     'ctfResolution'])
+        self.assertEqual([m['id'] for m in mics], list(range(1, 11)))
+        self.assertEqual(mics[0]['location'], 'mic001.mrc')
+        self.assertEqual(mics[2]['ctfDefocus'], 5.0)
+        self.assertIsNone(mics[0]['ctfResolution'])
+        self.assertAlmostEqual(mics[9]['ctfResolution'], 4.0)
+
+        mic = hsd.get_set_item(1, 3, ['id', 'ctfDefocus', 'micThumbData',
+                                      'psdData'])
+        self.assertEqual(mic, {'id': 3, 'ctfDefocus': 5.0,
+                               'micThumbData': b'thumb-data-3',
+                               'psdData': b'psd'})
+        defocus = hsd.get_set_column(1, 'ctfDefocus')
+        self.assertEqual(defocus.shape, (10,))
+        hsd.close()
+
+    def test_add_items(self):
+        print("=" * 80, "\nTesting h5py session items in batches...")
+        path = '/tmp/emhub-h5-batch.h5'
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+        hsd.add_set_item(1, 1, {'location': 'mic001', 'ctfDefocus': 1.0})
+        items = [{'id': i, 'location': 'mic%03d' % i, 'ctfDefocus': 1.0 * i,
+                  'micThumbData': b'thumb%d' % i} for i in range(2, 6)]
+        items[-1]['ctfResolution'] = 3.5  # New column in the batch
+        hsd.add_set_items(1, items)
+        hsd.update_set_items(1, [{'id': 2, 'ctfDefocus': 20.0},
+                                 {'id': 3, 'location': 'new003'}])
+        # Existing or repeated ids are rejected without adding anything
+        with self.assertRaises(Exception):
+            hsd.add_set_item(1, 2, {'location': 'dup002'})
+        with self.assertRaises(Exception):
+            hsd.add_set_items(1, [{'id': 6}, {'id': 6}])
+        # Unless the item is the same (e.g. a request sent again after
+        # its response was lost), then it is skipped
+        hsd.add_set_items(1, [items[2], {'id': 6, 'location': 'mic006'}])
+        hsd.add_set_item(1, 6, {'location': 'mic006'})
+        hsd.close()
+
+        hsd = H5SessionData(path, 'r')
+        mics = hsd.get_set_items(1, ['location', 'ctfDefocus',
+                                     'ctfResolution'])
+        self.assertEqual([m['location'] for m in mics],
+                         ['mic001', 'mic002', 'new003', 'mic004', 'mic005',
+                          'mic006'])
+        self.assertEqual([m['ctfDefocus'] for m in mics],
+                         [1.0, 20.0, 3.0, 4.0, 5.0, None])
+        self.assertEqual([m['ctfResolution'] for m in mics],
+                         [None, None, None, None, 3.5, None])
+        self.assertEqual(hsd.get_set_item(1, 4, ['micThumbData']),
+                         {'micThumbData': b'thumb4'})
+        # Item 1 only has column values and no group
+        self.assertEqual([m['micThumbData']
+                          for m in hsd.get_set_items(1, ['micThumbData'])],
+                         [b'', b'thumb2', b'thumb3', b'thumb4', b'thumb5',
+                          b''])
+        self.assertEqual(hsd.get_set_items(1, ['ctfFit'])[0]['ctfFit'], None)
+        stats = hsd.get_set_stats(1, ['ctfDefocus', 'ctfResolution'])
+        self.assertEqual(stats['ctfDefocus'].count, 5)
+        self.assertEqual(stats['ctfDefocus'].max, 20.0)
+        self.assertEqual(stats['ctfResolution'].count, 1)
+        hsd.close()
+
+    def test_column_types(self):
+        print("=" * 80, "\nTesting h5py session column types...")
+        path = '/tmp/emhub-h5-types.h5'
+        big = 2 ** 60 + 1
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+        hsd.add_set_item(1, 1, {'ctfDefocus': big, 'ctfFit': True,
+                                'ctfResolution': 3})
+        hsd.add_set_item(1, 2, {'ctfFit': False})
+        # Numeric columns are widened only when needed
+        hsd.add_set_item(1, 3, {'ctfFit': 2, 'ctfResolution': 3.5})
+        hsd.close()
+
+        hsd = H5SessionData(path, 'r')
+        attrs = ['ctfDefocus', 'ctfFit', 'ctfResolution']
+        mics = hsd.get_set_items(1, attrs)
+        self.assertEqual([[m[a] for a in attrs] for m in mics],
+                         [[big, 1, 3.0], [None, 0, None], [None, 2, 3.5]])
+        self.assertIsInstance(mics[0]['ctfDefocus'], int)
+        self.assertIsInstance(mics[1]['ctfFit'], int)
+        self.assertEqual(hsd.get_set_item(1, 1, ['ctfDefocus']),
+                         {'ctfDefocus': big})
+        self.assertEqual([m['id'] for m in
+                          hsd.get_set_items(1, ['id'], condition='ctfFit > 0')],
+                         [1, 3])
+        self.assertEqual(hsd.get_set_stats(1, ['ctfFit'])['ctfFit'].count, 3)
+        hsd.close()
+
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+        hsd.add_set_items(1, [{'id': 1, 'ctfFit': True}, {'id': 2}])
+        mics = hsd.get_set_items(1, ['ctfFit'])
+        self.assertEqual([m['ctfFit'] for m in mics], [True, None])
+        hsd.close()
+
+    def test_old_layout(self):
+        print("=" * 80, "\nTesting h5py session old layout...")
+        path = '/tmp/emhub-h5-old.h5'
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+        # Items stored as groups with attributes, as in older files
+        for i in range(1, 4):
+            group = hsd._file.create_group(hsd._getItemPath(1, i))
+            group.attrs.update(id=i, location='mic%d' % i, ctfDefocus=1.0 * i)
+        hsd.update_set_item(1, 2, {'ctfDefocus': 20.0})
+        hsd.close()
+
+        hsd = H5SessionData(path, 'r')
+        mics = hsd.get_set_items(1, ['location', 'ctfDefocus'])
+        self.assertEqual([m['ctfDefocus'] for m in mics], [1.0, 20.0, 3.0])
+        self.assertEqual(hsd.get_set_item(1, 3, ['location']),
+                         {'location': 'mic3'})
+        hsd.close()
+
+        # Adding items moves the values of the old items to the columns
+        hsd = H5SessionData(path, 'a')
+        hsd.add_set_item(1, 4, {'location': 'mic4', 'ctfDefocus': 4.0})
+        with self.assertRaises(Exception):
+            hsd.add_set_item(1, 2, {'location': 'dup2'})
+        hsd.update_set_item(1, 3, {'ctfDefocus': 30.0})
+        hsd.close()
+
+        hsd = H5SessionData(path, 'r')
+        mics = hsd.get_set_items(1, ['location', 'ctfDefocus'])
+        self.assertEqual([(m['id'], m['location'], m['ctfDefocus'])
+                          for m in mics],
+                         [(1, 'mic1', 1.0), (2, 'mic2', 20.0),
+                          (3, 'mic3', 30.0), (4, 'mic4', 4.0)])
+        self.assertEqual(hsd.get_set_stats(1, ['ctfDefocus'])['ctfDefocus']
+                         .count, 4)
+        hsd.close()
+
+
+    def test_images(self):
+        print("=" * 80, "\nTesting h5py session images...")
+        path = '/tmp/emhub-h5-images.h5'
+        data = bytes(range(256)) * 100
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+        # Images can be passed as base64 strings, but are stored as binary
+        hsd.add_set_item(1, 1, {'location': 'mic1',
+                                'micThumbData': bytes_to_base64(data)})
+        hsd.add_set_item(1, 2, {'location': 'mic2', 'psdData': data})
+        hsd.add_set_item(1, 3, {'location': 'mic3', 'psdData': 'newstr'})
+        # Older files stored base64 strings as attributes
+        itemGroup = hsd._file[hsd._getItemPath(1, 2)]
+        itemGroup.attrs['micThumbData'] = bytes_to_base64(b'old-data')
+        hsd.close()
+
+        hsd = H5SessionData(path, 'r')
+        dataset = hsd._file[hsd._getItemPath(1, 1)]['micThumbData']
+        self.assertEqual(dataset.dtype, np.uint8)
+        self.assertEqual(dataset.compression, 'gzip')
+        mics = hsd.get_set_items(1, ['micThumbData', 'psdData'])
+        self.assertEqual(mics[0]['micThumbData'], data)
+        self.assertEqual(mics[0]['psdData'], b'')
+        self.assertEqual(mics[1]['micThumbData'], b'old-data')
+        self.assertEqual(mics[1]['psdData'], data)
+        self.assertEqual(mics[2]['psdData'], b'newstr')
+        # Hashes are stored with the images (computed for older files)
+        md5 = hashlib.md5(data).hexdigest()
+        self.assertEqual(dataset.attrs['md5'], md5)
+        self.assertEqual(hsd.get_set_item_hash(1, 1, 'micThumbData'), md5)
+        self.assertEqual(hsd.get_set_item_hash(1, 2, 'micThumbData'),
+                         hashlib.md5(b'old-data').hexdigest())
+        self.assertIsNone(hsd.get_set_item_hash(1, 1, 'psdData'))
+        self.assertIsNone(hsd.get_set_item_hash(1, 4, 'psdData'))
+        hsd.close()
+
+
+    def test_condition(self):
+        print("=" * 80, "\nTesting h5py session conditions...")
+        path = '/tmp/emhub-h5-condition.h5'
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+        for i in range(1, 21):
+            attrs = {'location': 'mic%03d.mrc' % i,
+                     'ctfResolution': 2.0 + i / 4,
+                     'ctfFit': 0.05 * (i % 5)}
+            if i == 20:
+                del attrs['ctfFit']
+            hsd.add_set_item(1, i, attrs)
+
+        def _ids(**kwargs):
+            mics = hsd.get_set_items(1, ['ctfResolution'], **kwargs)
+            return [m['id'] for m in mics]
+
+        self.assertEqual(_ids(condition='ctfResolution < 4 and ctfFit > 0.1'),
+                         [3, 4])
+        self.assertEqual(_ids(condition='5 < id <= 8 or id in [1, 20]'),
+                         [1, 6, 7, 8, 20])
+        self.assertEqual(_ids(condition="ctfFit < 0.05"), [5, 10, 15])
+        self.assertEqual(_ids(condition="not id > 2"), [1, 2])
+        self.assertEqual(_ids(condition="location == 'mic002.mrc'"), [2])
+        self.assertEqual(_ids(orderBy='ctfFit desc', limit=5),
+                         [4, 9, 14, 19, 3])
+        self.assertEqual(_ids(orderBy='ctfResolution', limit=3), [1, 2, 3])
+        self.assertEqual(_ids(condition='ctfFit > 0.1',
+                              orderBy='ctfResolution desc', limit=2),
+                         [19, 18])
+        # Values are read only for the selected rows, in the given order
+        mics = hsd.get_set_items(1, ['ctfResolution', 'location'],
+                                 orderBy='ctfFit desc', limit=3)
+        self.assertEqual([(m['ctfResolution'], m['location']) for m in mics],
+                         [(3.0, 'mic004.mrc'), (4.25, 'mic009.mrc'),
+                          (5.5, 'mic014.mrc')])
+        self.assertEqual(hsd.get_set_items(1, ['ctfFit'],
+                                           condition='id > 100'), [])
+
+        for condition in ['ctfFit > 0.1; 1', '__import__("os")',
+                          'ctfFit.real > 1', 'badAttr > 1']:
+            with self.assertRaises(Exception):
+                hsd.get_set_items(1, ['id'], condition=condition)
+        hsd.close()
+
+
+    def test_stats(self):
+        print("=" * 80, "\nTesting h5py session stats...")
+        path = '/tmp/emhub-h5-stats.h5'
+        values = np.random.default_rng(0).normal(20000, 3000, 500)
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+        for i, v in enumerate(values):
+            hsd.add_set_item(1, i + 1, {'ctfDefocus': v})
+        hsd.add_set_item(1, 501, {'location': 'no-ctf'})
+        hsd.close()
+
+        hsd = H5SessionData(path, 'r')
+        stats = hsd.get_set_stats(1, ['ctfDefocus'])['ctfDefocus']
+        self.assertEqual(stats.count, 500)
+        self.assertAlmostEqual(stats.min, values.min())
+        self.assertAlmostEqual(stats.max, values.max())
+        self.assertAlmostEqual(stats.mean, values.mean())
+        self.assertAlmostEqual(stats.variance / values.var(), 1.0)
+        hist, edges = stats.histogram(10)
+        self.assertEqual(hist.sum(), 500)
+        expected, _ = np.histogram(values, bins=10)
+        # Fine bins are re-binned, so some values can move to a neighbour
+        self.assertLessEqual(np.abs(hist - expected).sum(), 40)
+        hsd.close()
+
+        # Replacing a value updates the stats
+        hsd = H5SessionData(path, 'a')
+        hsd.update_set_item(1, 1, {'ctfDefocus': 100000.0})
+        stats = hsd.get_set_stats(1, ['ctfDefocus'])['ctfDefocus']
+        self.assertEqual(stats.max, 100000.0)
+        self.assertEqual(stats.count, 500)
+        hsd.close()
+
+    def test_session_data_since(self):
+        print("=" * 80, "\nTesting session data since item...")
+        path = '/tmp/emhub-h5-since.h5'
+        hsd = H5SessionData(path, 'w')
+        hsd.create_set(1, {'label': 'Micrographs'})
+        for i in range(1, 6):
+            hsd.add_set_item(1, i, {'ctfDefocus': 1000.0 * i,
+                                    'ctfResolution': 3.0})
+        session = SimpleNamespace(data=hsd, stats={'numOfMics': 6},
+                                  json=lambda: {})
+        dc = DataContent(None)
+
+        data = dc.get_session_data(session)
+        self.assertEqual(data['defocus_plot'][1:], [1000.0 * i
+                                                    for i in range(1, 6)])
+        self.assertEqual(data['last_item_id'], 5)
+
+        hsd.add_set_item(1, 6, {'ctfDefocus': 6000.0, 'ctfResolution': 4.0})
+        data = dc.get_session_data(session, since_item_id=5)
+        self.assertEqual(data['defocus_plot'], ['Defocus', 6000.0])
+        self.assertEqual(data['resolution_plot'], ['Resolution', 4.0])
+        self.assertEqual(data['last_item_id'], 6)
+        self.assertEqual(data['counters']['ctf'], 6)
+        self.assertEqual(sum(data['ctf_defocus_hist']['data']), 6)
+
+        data = dc.get_session_data(session, since_item_id=6)
+        self.assertEqual(data['defocus_plot'], ['Defocus'])
+        self.assertEqual(data['last_item_id'], 6)
+        # Only the stats of the plotted values are stored
+        self.assertEqual(sorted(hsd._file['/Sets/1/stats']),
+                         ['ctfDefocus', 'ctfResolution'])
+        del hsd._file['/Sets/1/stats']
+        hsd.close()
+
+        # Stats of read only files without them are computed once
+        session.data = hsd = H5SessionData(path, 'r')
+        stats = hsd.get_set_stats(1, ['ctfDefocus'])['ctfDefocus']
+        self.assertEqual(stats.count, 6)
+        self.assertIs(hsd.get_set_stats(1, ['ctfDefocus'])['ctfDefocus'],
+                      stats)
+        self.assertEqual(dc.get_session_data(session)['counters']['ctf'], 6)
+        hsd.close()
+
+    def test_set_stats_merge(self):
+        values = np.random.default_rng(1).uniform(2, 8, 1000)
+        stats = SetStats()
+        for v in values[:10]:
+            stats.add(v)
+        stats.add(values[10:])
+        stats.add(np.nan)
+        self.assertEqual(stats.count, 1000)
+        self.assertAlmostEqual(stats.mean, values.mean())
+        self.assertAlmostEqual(stats.variance, values.var())
+        self.assertEqual(stats.histogram(5)[0].sum(), 1000)
+        self.assertEqual(SetStats(**stats.toDict()).json(),
+                         stats.json())
+
+
+class TestImage(unittest.TestCase):
+    def test_mrc_thumbnail(self):
+        import io
+        import mrcfile
+        from PIL import Image
+
+        print("=" * 80, "\nTesting mrc thumbnails...")
+        data = np.random.default_rng(0).normal(0, 1, (1100, 1600))
+        data = data.astype(np.float32)
+        binned = image.bin_image(data, (512, 512), blockRows=100)
+        self.assertEqual(binned.shape, (366, 533))
+        expected = data[:1098, :1599].reshape(366, 3, 533, 3).mean(axis=(1, 3))
+        self.assertTrue(np.allclose(binned, expected, atol=1e-5))
+
+        path = '/tmp/emhub-thumbnail.mrc'
+        with mrcfile.new(path, overwrite=True) as mrc:
+            mrc.set_data(data)
+
+        for fmt in ['PNG', 'JPEG']:
+            thumb = image.mrc_to_thumbnail(path, format=fmt)
+            img = Image.open(io.BytesIO(thumb))
+            self.assertEqual(img.format, fmt)
+            self.assertEqual(img.size, (512, 352))
+
+        b64 = image.mrc_to_base64(path, MAX_SIZE=(256, 256),
+                                  contrast_factor=5)
+        img = Image.open(io.BytesIO(image.base64_to_bytes(b64)))
+        self.assertEqual(img.size, (256, 176))
+
+
+class TestEventBus(unittest.TestCase):
+    def test_basic(self):
+        print("=" * 80, "\nTesting event bus...")
+        bus = EventBus(maxEvents=5)
+        bus.publish('session_created', {'session_id': 1})
+        bus.publish('session_item', {'session_id': 2, 'item_id': 1})
+        bus.publish('session_item', {'session_id': 1, 'item_id': 1})
+
+        events = bus.get_events(0, timeout=0)
+        self.assertEqual([e['id'] for e in events], [1, 2, 3])
+        events = bus.get_events(1, names=['session_item'],
+                                match={'session_id': 1}, timeout=0)
+        self.assertEqual([e['id'] for e in events], [3])
+        self.assertEqual(bus.get_events(3, timeout=0.1), [])
+
+        # Waiting clients are woken up when an event is published
+        timer = threading.Timer(0.2, bus.publish, args=['session_updated'])
+        timer.start()
+        t = time.time()
+        events = bus.get_events(bus.last_id, timeout=10)
+        self.assertLess(time.time() - t, 5)
+        self.assertEqual(events[0]['name'], 'session_updated')
+
+        # Only the last events are kept
+        for i in range(10):
+            bus.publish('session_item', {'session_id': 1, 'item_id': i})
+        self.assertEqual(len(bus.get_events(0, timeout=0)), 5)
+
+        # Ids given to clients are only valid for this bus and while the
+        # events after them are kept
+        self.assertEqual(bus.parse_id(bus.format_id(bus.last_id)),
+                         bus.last_id)
+        self.assertEqual(bus.parse_id(bus.format_id(bus.last_id - 5)),
+                         bus.last_id - 5)
+        for eventId in [bus.format_id(bus.last_id - 6),
+                        bus.format_id(bus.last_id + 1),
+                        EventBus().format_id(1), '3', 'bad-id', '']:
+            self.assertIsNone(bus.parse_id(eventId))
+        event = bus.get_events(bus.last_id - 1, timeout=0)[0]
+        self.assertTrue(sse_message(event, bus.format_id(event['id']))
+                        .startswith('id: %s-%d\nevent: session_item\n'
+                                    % (bus.epoch, event['id'])))
+
+
+class TestSessionDataCache(unittest.TestCase):
+    def _create_files(self, n):
+        paths = []
+        for i in range(n):
+            path = '/tmp/emhub-cache/session_%06d.h5' % i
+            hsd = H5SessionData(path, 'w')
+            hsd.create_set(1, {'name': 'set%d' % i})
+            hsd.close()
+            paths.append(path)
+        return paths
+
+    def test_basic(self):
+        print("=" * 80, "\nTesting session data cache...")
+        paths = self._create_files(4)
+        cache = SessionDataCache(maxSize=2, maxAge=60)
+
+        # The same open file is used while it is in the cache
+        d1 = cache.acquire(paths[0])
+        d1.close()
+        d2 = cache.acquire(paths[0])
+        self.assertIs(d1, d2)
+        self.assertEqual(d2.get_sets()[0]['name'], 'set0')
+        d2.close()
+
+        # Open in append mode, the file is shared while in use
+        # and closed when released
+        d3 = cache.acquire(paths[0], 'a')
+        self.assertIsNot(d3, d1)
+        d3.add_set_item(1, 1, {'ctfResolution': 3.5})
+        d4 = cache.acquire(paths[0], 'r')
+        self.assertIs(d4, d3)
+        d4.close()
+        d3.close()
+        self.assertEqual(len(cache), 0)
+        d4 = cache.acquire(paths[0], 'r')
+        self.assertEqual(len(d4.get_set_items(1, ['ctfResolution'])), 1)
+
+        # Least recently used files are closed, except if in use
+        for p in paths[1:]:
+            cache.acquire(p).close()
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.acquire(paths[0]), d4)
+        d4.close()
+        d4.close()
+
+        # Expired files are closed
+        cache._maxAge = 0
+        d5 = cache.acquire(paths[3])
+        self.assertEqual(len(cache), 1)
+        d5.close()
+        self.assertEqual(len(cache), 0)
+        cache.close_all()
+
+    def test_other_process(self):
+        print("=" * 80, "\nTesting session data cache with other process...")
+        import subprocess
+        import sys
+        path = self._create_files(1)[0]
+        cache = SessionDataCache()
+
+        def _run(mode, code):
+            script = ("from emhub.data import H5SessionData\n"
+                      "d = H5SessionData(%r, %r)\n%s\nd.close()"
+                      % (path, mode, code))
+            t = time.time()
+            subprocess.run([sys.executable, '-c', script], check=True,
+                           capture_output=True)
+            return time.time() - t
+
+        # Files kept open for reading do not block writers
+        d1 = cache.acquire(path)
+        d1.close()
+        self.assertLess(_run('a', "d.add_set_item(1, 1, {'ctfDefocus': 1.0})"),
+                        H5SessionData.LOCK_TIMEOUT)
+        self.assertEqual(len(cache), 1)
+
+        # Changes from the other process are read
+        d2 = cache.acquire(path)
+        self.assertIsNot(d2, d1)
+        self.assertEqual(d2.get_set_items(1, ['id']), [{'id': 1}])
+        d2.close()
+
+        # The open file is reused while it is not modified
+        d3 = cache.acquire(path)
+        self.assertIs(d3, d2)
+        d3.close()
+        _run('a', "d.add_set_item(1, 2, {'ctfDefocus': 2.0})")
+        d4 = cache.acquire(path)
+        self.assertEqual(len(d4.get_set_items(1, ['id'])), 2)
+        d4.close()
+
+        # A released write file is closed and can be read right away
+        d5 = cache.acquire(path, 'a')
+        d5.add_set_item(1, 3, {'ctfDefocus': 3.0})
+        d5.close()
+        self.assertLess(_run('r', "assert len(d.get_set_items(1, ['id'])) == 3"),
+                        H5SessionData.LOCK_TIMEOUT)
+        d6 = cache.acquire(path)
+        self.assertEqual(len(d6.get_set_items(1, ['id'])), 3)
+        d6.close()
+        self.assertIs(cache.acquire(path), d6)
+        d6.close()
+        cache.close_all()
+
+    def test_modified(self):
+        print("=" * 80, "\nTesting session data cache with file changes...")
+        path = self._create_files(1)[0]
+        cache = SessionDataCache()
+
+        d1 = cache.acquire(path)
+        self.assertEqual(d1.get_set_items(1, ['id']), [])
+        d1.close()
+
+        # Write from outside the cache (e.g. another process)
+        os.utime(path, (0, 0))
+        d2 = cache.acquire(path)
+        self.assertIsNot(d1, d2)
+        d2.close()
+        cache.close_all()
+
+
 class TestPytablesSessionData(unittest.TestCase):
     def test_basic(self):
         setId = 1
@@ -210,6 +1039,44 @@ class TestPytablesSessionData(unittest.TestCase):
 
         psd.close()
 
+    def test_data(self):
+        print("=" * 80, "\nTesting pytables session images...")
+        path = '/tmp/pytables-data.h5'
+        psd = PytablesSessionData(path, 'w')
+        psd.create_set(1, {})
+        for i in range(1, 4):
+            psd.add_item(1, itemId=i, location='mic%d' % i,
+                         psdData=b'psd%d' % i)
+        psd.update_item(1, itemId=2, psdData=b'psd2')  # same size
+        psd.update_item(1, itemId=3, psdData='newstr')  # not base64
+        psd.add_item(1, itemId=4, micThumbData=b'thumb4')
+        psd.close()
+
+        psd = PytablesSessionData(path, 'r')
+        self.assertEqual([m.psdData for m in psd.get_items(1, ['psdData'])],
+                         [b'psd1', b'psd2', b'newstr', b''])
+        self.assertEqual(psd.get_item(1, 4, ['micThumbData']).micThumbData,
+                         b'thumb4')
+        psd.close()
+
+        # Older files have the images as base64 strings in the table
+        class OldMicrograph(PytablesSessionData.Micrograph):
+            micThumbData = tbl.StringCol(256000)
+            psdData = tbl.StringCol(256000)
+            ctfFitData = tbl.StringCol(256000)
+            shiftPlotData = tbl.StringCol(256000)
+
+        with tbl.open_file(path, 'w') as f:
+            f.create_group('/Micrographs', 'set001', createparents=True)
+            f.create_table('/Micrographs/set001', 'mics_tbl', OldMicrograph)
+
+        psd = PytablesSessionData(path, 'a')
+        psd.add_item(1, itemId=1, location='mic1', psdData=b'psd1')
+        psd.update_item(1, itemId=1, micThumbData='dGh1bWIx')
+        mic = psd.get_item(1, 1, ['psdData', 'micThumbData', 'shiftPlotData'])
+        self.assertEqual(mic, (b'psd1', b'thumb1', b''))
+        psd.close()
+
 
 class TestDataLog(unittest.TestCase):
     @classmethod
@@ -239,3 +1106,107 @@ class TestDataLog(unittest.TestCase):
         logs = dl.get_logs()
         self.assertEqual(2, len(logs))
         dl.close()
+
+    def test_query(self):
+        print("=" * 80, "\nTesting logs query...")
+
+        dbPath = '/tmp/emhub-logs-query.sqlite'
+        dl = DataLog(dbPath, cleanDb=True)
+
+        for i in range(20):
+            dl.log(i % 2, 'operation', 'update_%s' % (i % 3), i)
+
+        logs = dl.get_logs()
+        self.assertEqual(20, len(logs))
+        keys = [(log.timestamp, log.id) for log in logs]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+        self.assertEqual(10, len(dl.get_logs(user_id=1)))
+        self.assertEqual(7, len(dl.get_logs(log_type='operation',
+                                            log_name='update_0')))
+        self.assertEqual(0, len(dl.get_logs(log_type='error')))
+        self.assertEqual(20, len(dl.get_logs(start=logs[-1].timestamp,
+                                             end=logs[0].timestamp)))
+
+        # Retrieve all logs of a user page by page
+        pages, last = [], {}
+        while True:
+            page = dl.get_logs(user_id=0, limit=3, **last)
+            if not page:
+                break
+            pages.append(page)
+            last = {'before_timestamp': page[-1].timestamp,
+                    'before_id': page[-1].id}
+        self.assertEqual([log.id for p in pages for log in p],
+                         [log.id for log in logs if log.user_id == 0])
+
+        # Check that indexes were created
+        engine = dl._db_session.get_bind()
+        indexes = {ix['name']
+                   for ix in sqlalchemy.inspect(engine).get_indexes('logs')}
+        self.assertEqual(indexes, {'ix_logs_timestamp',
+                                   'ix_logs_user_timestamp',
+                                   'ix_logs_type_name'})
+        dl.close()
+
+    def test_archive(self):
+        print("=" * 80, "\nTesting logs archive...")
+
+        dbPath = '/tmp/emhub-logs-archive.sqlite'
+        archivePath = '/tmp/emhub-logs-archive'
+        shutil.rmtree(archivePath, ignore_errors=True)
+        dl = DataLog(dbPath, cleanDb=True)
+
+        for i in range(10):
+            dl.log(1, 'operation', 'update_booking', i, id=i)
+
+        # Move the 6 oldest logs to the past, in two different months
+        now = dl.now()
+        for log in dl.get_logs()[4:]:
+            months = 3 if log.args[0] < 3 else 2
+            log.timestamp = now - dt.timedelta(days=30 * months)
+        dl.commit()
+
+        counts = dl.archive_logs(archivePath, days=30, batchSize=4)
+        self.assertEqual(sum(counts.values()), 6)
+        self.assertEqual(len(counts), 2)
+        self.assertEqual(sorted(log.args[0] for log in dl.get_logs()),
+                         [6, 7, 8, 9])
+
+        archived = []
+        for month in counts:
+            fn = os.path.join(archivePath, 'logs-%s.jsonl.gz' % month)
+            archived.extend(DataLog.read_archive(fn))
+        self.assertEqual(sorted(log['args'][0] for log in archived),
+                         [0, 1, 2, 3, 4, 5])
+        self.assertEqual(archived[0]['name'], 'update_booking')
+
+        # Nothing else to archive
+        self.assertEqual(dl.archive_logs(archivePath, days=30), {})
+        dl.close()
+
+    def test_buffered(self):
+        print("=" * 80, "\nTesting buffered logs...")
+
+        dbPath = '/tmp/emhub-logs-buffered.sqlite'
+        dl = DataLog(dbPath, cleanDb=True, buffered=True,
+                     maxQueue=10, batchSize=4)
+
+        for i in range(25):
+            self.assertIsNone(dl.log(1, 'data', 'log_%02d' % i, i, n=i))
+
+        # Reading logs should wait for the pending ones
+        logs = dl.get_logs()
+        self.assertEqual(25, len(logs))
+        self.assertEqual(logs[0].name, 'log_24')
+        self.assertEqual(logs[0].args, [24])
+
+        # After shutdown, logs are written synchronously
+        dl.log(1, 'data', 'pending')
+        dl.shutdown()
+        self.assertIsNotNone(dl.log(1, 'data', 'last'))
+        dl.close()
+
+        dl = DataLog(dbPath)
+        self.assertEqual(27, len(dl.get_logs()))
+        dl.close()
@@ -94,11 +94,22 @@ def get_quarter(date=None):
     return _dt(start), _dt(end)
 
 
-def send_json_data(data):
+def send_json_data(data, conditional=False):
+    """ Send data as a JSON response.
+    If conditional is True, an ETag is computed from the content and
+    a 304 (Not Modified) response is sent if the request If-None-Match
+    header matches it.
+    """
     import flask
     resp = flask.make_response(json.dumps(data))
     resp.status_code = 200
     resp.headers['Access-Control-Allow-Origin'] = '*'
+    if conditional:
+        resp.add_etag()
+        # Content depends on the logged user and always need validation
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+        resp.make_conditional(flask.request)
     return resp
 
 
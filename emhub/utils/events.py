@@ -0,0 +1,120 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+import json
+import uuid
+import threading
+from collections import deque
+
+
+class EventBus:
+    """ Publish events to clients waiting for them in other threads
+    (e.g. long-poll or Server-Sent Events requests).
+
+    Each event gets an increasing id, so clients can request the events
+    after the last one they have seen and not miss those published
+    between requests. Only the last maxEvents are kept in memory.
+    Events are only delivered within the same process.
+
+    Ids given to clients (see format_id) also contain an epoch of the
+    bus, so ids from another process or from before a restart are
+    detected instead of silently skipping events.
+    """
+    def __init__(self, maxEvents=1000):
+        self._events = deque(maxlen=maxEvents)
+        self._lastId = 0
+        self._cond = threading.Condition()
+        self.epoch = uuid.uuid4().hex[:8]
+
+    @property
+    def last_id(self):
+        return self._lastId
+
+    def format_id(self, eventId):
+        """ Return the id of the event to be given to clients. """
+        return '%s-%d' % (self.epoch, eventId)
+
+    def parse_id(self, value):
+        """ Return the event id from a formatted one (e.g from the
+        Last-Event-ID header), or None if it was not given by this bus
+        or the events after it are no longer kept.
+        """
+        epoch, _, eventId = str(value).rpartition('-')
+        if epoch != self.epoch or not eventId.isdigit():
+            return None
+
+        eventId = int(eventId)
+        with self._cond:
+            firstId = self._events[0]['id'] if self._events else 1
+            if firstId - 1 <= eventId <= self._lastId:
+                return eventId
+        return None
+
+    def publish(self, name, data=None):
+        """ Add a new event and wake up waiting clients. """
+        with self._cond:
+            self._lastId += 1
+            self._events.append({'id': self._lastId,
+                                 'name': name,
+                                 'data': data or {}})
+            self._cond.notify_all()
+
+    def get_events(self, afterId=0, names=None, match=None, timeout=None):
+        """ Return the events after the given id, waiting up to timeout
+        seconds if there are none.
+
+        Args:
+            afterId: id of the last event received by the client.
+            names: optional list of event names to return.
+            match: optional dict, only return events with these values
+                in their data (e.g {'session_id': 1}).
+            timeout: seconds to wait for events, None to wait forever
+                and 0 to return immediately.
+        """
+        def _select():
+            return [e for e in self._events
+                    if e['id'] > afterId
+                    and (names is None or e['name'] in names)
+                    and (match is None or
+                         all(e['data'].get(k) == v for k, v in match.items()))]
+
+        with self._cond:
+            events = _select()
+            if not events and timeout != 0:
+                self._cond.wait_for(_select, timeout)
+                events = _select()
+            return events
+
+
+def sse_message(event, eventId=None):
+    """ Format the event as a Server-Sent Events message, eventId
+    is the id sent to the client (event['id'] by default).
+    """
+    if eventId is None:
+        eventId = event['id']
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (eventId, event['name'],
+                                                 json.dumps(event['data']))
@@ -27,6 +27,7 @@
 import io
 import numpy as np
 import base64
+import binascii
 import mrcfile
 
 from PIL import Image, ImageEnhance, ImageOps
@@ -55,6 +56,37 @@ def pil_to_base64(pil_img):
     return base64.b64encode(img_io.getvalue()).decode("utf-8")
 
 
+def bytes_to_base64(data):
+    """ Encode binary data (e.g PNG file content) as base64 string. """
+    return base64.b64encode(data).decode("utf-8")
+
+
+def base64_to_bytes(data):
+    """ Decode a base64 string into binary data. """
+    return base64.b64decode(data)
+
+
+def data_to_bytes(data):
+    """ Return image data as bytes. Strings are decoded from base64,
+    or just encoded if they are not valid base64.
+    """
+    if isinstance(data, str):
+        try:
+            return base64.b64decode(data, validate=True)
+        except binascii.Error:
+            return data.encode()
+    return data
+
+
+def image_mimetype(data):
+    """ Guess the mimetype of the image from its first bytes. """
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/png'
+
+
 def fn_to_blob(filename):
     """ Read the image filename as a PIL image
     and encode it as base64.
@@ -68,24 +100,55 @@ def fn_to_blob(filename):
         return np.array(0)
 
 
-def mrc_to_base64(filename, MAX_SIZE=(512,512), contrast_factor=None):
-    """ Convert real float32 mrc to base64.
-    Convert to int8 first, then scale with Pillow.
+def bin_image(data, maxSize, blockRows=256):
+    """ Reduce the image by averaging blocks of pixels, with the largest
+    integer factor that keeps it not smaller than maxSize (width, height).
+    The final size can then be adjusted with Pillow.
+
+    Blocks of rows are processed at a time, so memory-mapped images are
+    read only once and never fully loaded into memory.
     """
-    mrc_img = mrcfile.open(filename, permissive=True)
+    h, w = data.shape
+    factor = max(w // maxSize[0], h // maxSize[1], 1)
+    if factor == 1:
+        return np.asarray(data, dtype=np.float32)
 
-    if mrc_img.is_volume():
-        imfloat = mrc_img.data[0, :, :]
-    else:
-        imfloat = mrc_img.data
+    bh, bw = h // factor, w // factor
+    binned = np.empty((bh, bw), dtype=np.float32)
+    step = max(blockRows // factor, 1)  # Output rows per block
 
-    imean = imfloat.mean()
-    isd = imfloat.std()
+    for r in range(0, bh, step):
+        n = min(step, bh - r)
+        block = data[r * factor:(r + n) * factor, :bw * factor]
+        binned[r:r + n] = block.reshape(n, factor, bw, factor).mean(
+            axis=(1, 3), dtype=np.float32)
 
-    iMax = min(imean + 3 * isd, imfloat.max())
-    iMin = max(imean - 3 * isd, imfloat.min())
-    im255 = ((imfloat - iMin) / (iMax - iMin) * 255).astype(np.uint8)
-    mrc_img.close()
+    return binned
+
+
+def mrc_to_thumbnail(filename, MAX_SIZE=(512, 512), contrast_factor=None,
+                     format='PNG', quality=90):
+    """ Read a real mrc image and return a thumbnail as bytes in the
+    given format (PNG, JPEG or WEBP).
+
+    The file is memory-mapped and binned first, then the binned image
+    is normalized to uint8 (mean +/- 3 std) and scaled with Pillow.
+    """
+    with mrcfile.mmap(filename, mode='r', permissive=True) as mrc_img:
+        data = mrc_img.data
+        if data.ndim == 3:
+            data = data[0, :, :]
+        binned = bin_image(data, MAX_SIZE)
+
+    # Compute statistics in a single pass over the (small) binned image
+    values = binned.ravel().astype(np.float64)
+    imean = values.sum() / values.size
+    isd = np.sqrt(max(np.dot(values, values) / values.size - imean ** 2, 0))
+
+    iMax = min(imean + 3 * isd, binned.max())
+    iMin = max(imean - 3 * isd, binned.min())
+    scale = 255 / (iMax - iMin) if iMax > iMin else 0
+    im255 = ((np.clip(binned, iMin, iMax) - iMin) * scale).astype(np.uint8)
 
     pil_img = Image.fromarray(im255)
 
@@ -95,6 +158,18 @@ def mrc_to_base64(filename, MAX_SIZE=(512,512), contrast_factor=None):
     pil_img.thumbnail(MAX_SIZE)
 
     img_io = io.BytesIO()
-    pil_img.save(img_io, format='PNG')
+    if format.upper() == 'PNG':
+        pil_img.save(img_io, format='PNG')
+    else:
+        pil_img.save(img_io, format=format, quality=quality)
 
-    return base64.b64encode(img_io.getvalue()).decode("utf-8")
+    return img_io.getvalue()
+
+
+def mrc_to_base64(filename, MAX_SIZE=(512,512), contrast_factor=None,
+                  format='PNG'):
+    """ Convert real float32 mrc to a base64 thumbnail
+    (see mrc_to_thumbnail).
+    """
+    return bytes_to_base64(mrc_to_thumbnail(filename, MAX_SIZE,
+                                            contrast_factor, format))